@@ -8,6 +8,7 @@ setup=$PWD/minmt-setup.py
 train=$PWD/minmt-train.py
 avrge=$PWD/minmt-average.py
 trans=$PWD/minmt-translate.py
+corpus=$PWD/minmt-corpus.py
 
 tokenizer=$josep/MiNMT/tools/tokenizer.py
 data=$josep/data
@@ -21,37 +22,13 @@ stovec=$josep/stovec
 rm -r data_corpus
 mkdir "data_corpus"
 
-	for corpus in ECB EMEA Europarl GNOME JRC-Acquis KDE4 news-commentary-v14 TED2013 Wikipedia; do
-	    echo $corpus
-      echo train ...
-	    fsrc=$stovec/clean.$corpus.en-fr.en.trn.bpe.vec.max_sim0.5_k5_n0_t0.8.src
-      ftgt=$stovec/clean.$corpus.en-fr.en.trn.bpe.vec.max_sim0.5_k5_n0_t0.8.tgt
-	    fsim=$stovec/clean.$corpus.en-fr.en.trn.bpe.vec.max_sim0.5_k5_n0_t0.8.sim
-	    fpre=$stovec/clean.$corpus.en-fr.en.trn.bpe.vec.max_sim0.5_k5_n0_t0.8.pre
-	    cat $fsrc >> data_corpus/trn_src
-	    cat $ftgt >> data_corpus/trn_tgt
-	    cat $fsim >> data_corpus/trn_sim
-	    cat $fpre >> data_corpus/trn_pre
-	    echo train ok
+domains=ECB,EMEA,Europarl,GNOME,JRC-Acquis,KDE4,news-commentary-v14,TED2013,Wikipedia
 
-	    echo val ...
-	    fsrc=$stovec/clean.$corpus.en-fr.en.val.bpe.vec.sim0.5_k5_n0_t0.8.src
-	    ftgt=$stovec/clean.$corpus.en-fr.en.val.bpe.vec.sim0.5_k5_n0_t0.8.tgt
-	    fsim=$stovec/clean.$corpus.en-fr.en.val.bpe.vec.sim0.5_k5_n0_t0.8.sim
-	    fpre=$stovec/clean.$corpus.en-fr.en.val.bpe.vec.sim0.5_k5_n0_t0.8.pre
-	    cat $fsrc >> data_corpus/val_src
-	    cat $ftgt >> data_corpus/val_tgt
-	    cat $fsim >> data_corpus/val_sim
-	    cat $fpre >> data_corpus/val_pre
-	    echo val ok
+### one pass over src/tgt/sim/pre files of each domain (in parallel), examples with empty sim are skipped
+echo train ...
+python3 $corpus -i $stovec/clean.{domain}.en-fr.en.trn.bpe.vec.max_sim0.5_k5_n0_t0.8.{ext} -o data_corpus/trn_{ext}_plein -domains $domains || exit 1
+echo train ok
 
-   echo corpus suivant :
-
-done
-
-
-echo nettoyage des lignes avec sim vide ...
-
-python3 remove_empty_lines.py
-
-rm data_corpus/trn_src data_corpus/trn_sim data_corpus/trn_pre data_corpus/trn_tgt data_corpus/val_src data_corpus/val_sim data_corpus/val_pre data_corpus/val_tgt
\ No newline at end of file
+echo val ...
+python3 $corpus -i $stovec/clean.{domain}.en-fr.en.val.bpe.vec.sim0.5_k5_n0_t0.8.{ext} -o data_corpus/val_{ext}_plein -domains $domains || exit 1
+echo val ok
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import random
+import logging
+import torch
+from transformer.Dataset import Vocab
+from transformer.Model import Encoder_Decoder, prepare_source, prepare_target, numparameters
+from transformer.Optimizer import LabelSmoothing_NLL
+from transformer.Inference import Inference
+from transformer.Learning import is_oom, reset_peak_memory, peak_memory
+from tools.Tools import create_logger, read_dnet
+
+######################################################################
+### Options ##########################################################
+######################################################################
+
+class Options():
+  def __init__(self, argv):
+    self.prog = argv.pop(0)
+    self.dnet = None
+    self.mode = 'train'
+    self.batch_type = None
+    self.min_batch = None
+    self.max_batch = None
+    self.length = 30
+    self.beam_size = 4
+    self.threads = None
+    self.probe_steps = 3
+    self.max_memory = 0
+    self.output = None
+    self.cuda = False
+    self.seed = 12345
+    log_file = 'stderr'
+    log_level = 'info'
+
+    while len(argv):
+      tok = argv.pop(0)
+      if tok=="-h":
+        self.usage()
+
+      elif tok=='-dnet' and len(argv):
+        self.dnet = argv.pop(0)
+        self.dnet = self.dnet[:-1] if self.dnet[-1] == '/' else self.dnet  ### remove trailing '/'
+      elif tok=='-mode' and len(argv):
+        self.mode = argv.pop(0)
+      elif tok=='-batch_type' and len(argv):
+        self.batch_type = argv.pop(0)
+      elif tok=='-min_batch' and len(argv):
+        self.min_batch = int(argv.pop(0))
+      elif tok=='-max_batch' and len(argv):
+        self.max_batch = int(argv.pop(0))
+      elif tok=='-length' and len(argv):
+        self.length = int(argv.pop(0))
+      elif tok=='-beam_size' and len(argv):
+        self.beam_size = int(argv.pop(0))
+      elif tok=='-threads' and len(argv):
+        self.threads = [int(t) for t in argv.pop(0).split(',')]
+      elif tok=='-probe_steps' and len(argv):
+        self.probe_steps = int(argv.pop(0))
+      elif tok=='-max_memory' and len(argv):
+        self.max_memory = int(argv.pop(0))
+      elif tok=='-o' and len(argv):
+        self.output = argv.pop(0)
+
+      elif tok=="-cuda":
+        self.cuda = True
+      elif tok=="-seed" and len(argv):
+        self.seed = int(argv.pop(0))
+      elif tok=="-log_file" and len(argv):
+        log_file = argv.pop(0)
+      elif tok=="-log_level" and len(argv):
+        log_level = argv.pop(0)
+
+      else:
+        self.usage('Unrecognized {} option'.format(tok))
+
+    if self.dnet is None:
+      self.usage('missing -dnet option')
+    if self.mode not in ['train', 'translate']:
+      self.usage('bad -mode option')
+    ### defaults of minmt-train.py (tokens) and minmt-translate.py (sentences)
+    if self.batch_type is None:
+      self.batch_type = 'tokens' if self.mode == 'train' else 'sentences'
+    if self.batch_type not in ['tokens', 'sentences']:
+      self.usage('bad -batch_type option')
+    if self.min_batch is None:
+      self.min_batch = 1024 if self.batch_type == 'tokens' else 8
+    if self.max_batch is None:
+      self.max_batch = 65536 if self.batch_type == 'tokens' else 1024
+    if self.threads is None:
+      self.threads = [2**i for i in range(os.cpu_count().bit_length()) if 2**i <= os.cpu_count()]
+    if self.output is None:
+      self.output = self.dnet + '/autotune.' + self.mode
+
+    create_logger(log_file,log_level)
+    random.seed(self.seed)
+    torch.manual_seed(self.seed)
+    logging.info("Options = {}".format(self.__dict__))
+
+  def usage(self, messg=None):
+    if messg is not None:
+      sys.stderr.write(messg + '\n')
+    sys.stderr.write('''usage: {} -dnet DIR [Options]
+   -dnet          DIR : network directory [must exist]
+   -mode       STRING : probe learning (forward/backward/update) or translation (beam decoding): train, translate ({})
+   -o            FILE : output file with the fastest configuration (DIR/autotune.MODE)
+
+   [Probes]
+   -batch_type STRING : sentences or tokens (tokens for train, sentences for translate)
+   -min_batch     INT : first batch size probed, doubled after each probe (1024 tokens, 8 sentences)
+   -max_batch     INT : last batch size probed (65536 tokens, 1024 sentences)
+   -length        INT : number of tokens of synthetic (src/pre/tgt) sentences ({})
+   -beam_size     INT : size of beam when probing translation ({})
+   -threads    STRING : comma-separated numbers of threads probed (powers of 2 up to the number of cpus)
+   -probe_steps   INT : steps measured per probe (after one warmup step) ({})
+   -max_memory    INT : peak memory (MB) allowed in a probe, 0 for no limit other than running out of memory ({})
+
+   -cuda              : use cuda device instead of cpu ({})
+   -seed          INT : seed for randomness ({})
+   -log_file     FILE : log file  (stderr)
+   -log_level  STRING : log level [debug, info, warning, critical, error] (info)
+   -h                 : this help
+
+Peak memory of each probe is the one allocated by torch in cuda devices, the process maximum resident
+size in cpu (reset before each probe, linux only: -max_memory is not checked where it cannot be reset).
+'''.format(self.prog, self.mode, self.length, self.beam_size, self.probe_steps, self.max_memory, self.cuda, self.seed))
+    sys.exit()
+
+######################################################################
+### Probes ###########################################################
+######################################################################
+
+def synthetic_batch(batch_size, batch_type, length, voc):
+  ### batch of random sentences (as built by Dataset) with length tokens
+  n_sents = max(1, batch_size // (length+2)) if batch_type == 'tokens' else batch_size
+  return [[voc.idx_bos] + [random.randint(6, len(voc)-1) for _ in range(length)] + [voc.idx_eos] for _ in range(n_sents)]
+
+def probe_train(model, optim, criter, batch_size, o, src_voc, tgt_voc, device):
+  ### returns target tokens per second of learning steps (forward/backward/update)
+  batch_src = synthetic_batch(batch_size, o.batch_type, o.length, src_voc)
+  batch_pre = synthetic_batch(batch_size, o.batch_type, o.length, tgt_voc)
+  batch_tgt = synthetic_batch(batch_size, o.batch_type, o.length, tgt_voc)
+  model.train()
+  ntok, secs = 0, 0.
+  for step in range(o.probe_steps+1):
+    tic = time.time()
+    src, msk_src = prepare_source(batch_src, src_voc.idx_pad, device)
+    pre, msk_pre = prepare_source(batch_pre, tgt_voc.idx_pad, device)
+    tgt, ref, msk_tgt = prepare_target(batch_tgt, tgt_voc.idx_pad, tgt_voc.idx_sep, tgt_voc.idx_msk, False, device)
+    optim.zero_grad()
+    pred = model.forward(src, pre, tgt, msk_src, msk_pre, msk_tgt)
+    loss = criter(pred, ref)
+    loss.backward()
+    optim.step()
+    loss = loss.item() ### waits for device
+    if step > 0: ### first step is warmup
+      secs += time.time() - tic
+      ntok += torch.sum(ref != tgt_voc.idx_pad).item()
+  return ntok / secs
+
+def probe_translate(inference, batch_size, o, src_voc, tgt_voc):
+  ### returns source tokens per second of beam decoding
+  batch_src = synthetic_batch(batch_size, o.batch_type, o.length, src_voc)
+  batch_pre = synthetic_batch(batch_size, o.batch_type, o.length, tgt_voc)
+  testset = [([i for i in range(len(batch_src))], [batch_src, batch_pre])]
+  ntok, secs = 0, 0.
+  for step in range(o.probe_steps+1):
+    tic = time.time()
+    inference.translate(testset, os.devnull)
+    if step > 0: ### first step is warmup
+      secs += time.time() - tic
+      ntok += sum([len(s) for s in batch_src])
+  return ntok / secs
+
+######################################################################
+### MAIN #############################################################
+######################################################################
+
+if __name__ == '__main__':
+
+  tic = time.time()
+  o = Options(sys.argv)
+  n, src_voc, tgt_voc = read_dnet(o.dnet)
+  src_voc = Vocab(src_voc)
+  tgt_voc = Vocab(tgt_voc)
+
+  ###################
+  ### build model ###
+  ###################
+  device = torch.device('cuda' if o.cuda and torch.cuda.is_available() else 'cpu')
+  model = Encoder_Decoder(n['n_layers'], n['ff_dim'], n['n_heads'], n['emb_dim'], n['qk_dim'], n['v_dim'], n['dropout'], n['share_embeddings'], len(src_voc), len(tgt_voc), src_voc.idx_pad).to(device)
+  logging.info('Built model (#params, size) = ({}) in device {}'.format(', '.join([str(f) for f in numparameters(model)]), next(model.parameters()).device ))
+  if o.mode == 'train':
+    optim = torch.optim.Adam(model.parameters(), weight_decay=n['weight_decay'], betas=(n['beta1'], n['beta2']), eps=n['eps'])
+    criter = LabelSmoothing_NLL(len(tgt_voc), src_voc.idx_pad, 0.1).to(device)
+  else:
+    o.n_best, o.max_size, o.alpha, o.format, o.mask_prefix, o.profile_steps = 1, o.length+2, 0.0, 'i', False, '' ### hypotheses of length tokens
+    inference = Inference(model, src_voc, tgt_voc, o, device)
+
+  ##############
+  ### probes ###
+  ##############
+  results = [] #(tokens/sec, threads, batch_size, peak MB)
+  for threads in o.threads:
+    torch.set_num_threads(threads)
+    batch_size = o.min_batch
+    while batch_size <= o.max_batch:
+      reset_peak_memory(device)
+      try:
+        if o.mode == 'train':
+          tok_per_sec = probe_train(model, optim, criter, batch_size, o, src_voc, tgt_voc, device)
+        else:
+          tok_per_sec = probe_translate(inference, batch_size, o, src_voc, tgt_voc)
+      except RuntimeError as e:
+        if not is_oom(e):
+          raise
+        tok_per_sec = None
+      ### graph of a failed probe is freed once out of the except clause
+      if tok_per_sec is None:
+        if device.type == 'cuda':
+          torch.cuda.empty_cache()
+        logging.info('threads: {} batch_size: {} {} out of memory'.format(threads, batch_size, o.batch_type))
+        break
+      peak = peak_memory(device)
+      logging.info('threads: {} batch_size: {} {} tok/sec: {:.1f} peak: {}'.format(threads, batch_size, o.batch_type, tok_per_sec, 'n/a' if peak is None else '{:.1f}MB'.format(peak)))
+      if o.max_memory and peak is not None and peak > o.max_memory:
+        logging.info('peak memory exceeds -max_memory {}MB'.format(o.max_memory))
+        break
+      results.append((tok_per_sec, threads, batch_size, peak))
+      batch_size *= 2
+
+  if len(results) == 0:
+    logging.error('No configuration fits in memory')
+    sys.exit()
+
+  ##############
+  ### output ###
+  ##############
+  tok_per_sec, threads, batch_size, peak = max(results)
+  best = {'mode': o.mode, 'batch_size': batch_size, 'batch_type': o.batch_type, 'num_threads': threads, 'tok_per_sec': round(tok_per_sec, 1), 'peak_mb': None if peak is None else round(peak, 1), 'device': device.type}
+  if o.mode == 'translate':
+    best['beam_size'] = o.beam_size
+  with open(o.output, 'w') as f:
+    f.write(str(best) + '\n')
+  logging.info('Fastest configuration {} written in {}'.format(best, o.output))
+  logging.info('use: OMP_NUM_THREADS={} minmt-{}.py -batch_size {} -batch_type {}{}'.format(threads, o.mode, batch_size, o.batch_type, ' -beam_size {}'.format(o.beam_size) if o.mode == 'translate' else ''))
+
+  toc = time.time()
+  logging.info('Done ({:.2f} seconds)'.format(toc-tic))
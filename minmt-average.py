@@ -2,10 +2,13 @@
 
 import time
 import sys
+import os
 import torch
 import logging
 import glob
+from concurrent.futures import ThreadPoolExecutor
 from tools.Tools import create_logger
+from transformer.Model import is_weights_file, load_weights, fuse_projections
 
 ######################################################################
 ### Options ##########################################################
@@ -15,6 +18,10 @@ class Options():
   def __init__(self, argv):
     self.prog = argv.pop(0)
     self.dnet = None
+    self.last_n = 0
+    self.first_step = 0
+    self.last_step = 0
+    self.steps = []
 
     log_file = 'stderr'
     log_level = 'info'
@@ -25,6 +32,10 @@ class Options():
         self.usage()
       elif tok=="-dnet" and len(argv):
         self.dnet = argv.pop(0)
+      elif tok=="-last_n" and len(argv):
+        self.last_n = int(argv.pop(0))
+      elif tok=="-steps" and len(argv):
+        self.parse_steps(argv.pop(0))
       elif tok=="-log_file" and len(argv):
         log_file = argv.pop(0)
       elif tok=="-log_level" and len(argv):
@@ -37,17 +48,64 @@ class Options():
     if self.dnet is None:
       logging.error('missing -dnet option')
       self.usage()
+    if len(self.steps):
+      available = set([checkpoint_step(f) for f in checkpoint_files(self.dnet + '/network')])
+      missing = [step for step in self.steps if step not in available]
+      if len(missing):
+        self.usage('No checkpoint found for steps {} in {}'.format(missing, self.dnet))
 
-  def usage(self):
+  def parse_steps(self, steps):
+    ### A:B (either bound may be empty or 0) or a comma-separated list of steps S1,S2,...
+    try:
+      if ':' in steps:
+        first, last = steps.split(':')
+        self.first_step, self.last_step = int(first or 0), int(last or 0)
+      else:
+        self.steps = [int(step) for step in steps.split(',')]
+    except ValueError:
+      self.usage('Invalid -steps {}'.format(steps))
+    if self.first_step < 0 or self.last_step < 0 or (self.last_step and self.last_step < self.first_step):
+      self.usage('Invalid -steps range {}'.format(steps))
+    if len(set(self.steps)) != len(self.steps):
+      self.usage('Duplicated steps in -steps {}'.format(steps))
+
+  def usage(self, messg=None):
+    if messg is not None:
+      sys.stderr.write(messg + '\n')
     sys.stderr.write('''usage: {} -dnet DIR [Options]
    -dnet         DIR : network directory
+   -last_n       INT : average the last INT checkpoints, 0 for all ({})
+   -steps        A:B : average checkpoints with A <= step <= B, empty or 0 for no bound ({}:{})
+   -steps  S1,S2,... : average checkpoints of the given steps (all of them must exist)
 
    -log_file    FILE : log file  (stderr)
    -log_level    STR : log level [debug, info, warning, critical, error] (info)
    -h                : this help
-'''.format(self.prog))
+'''.format(self.prog, self.last_n, self.first_step, self.last_step))
     sys.exit()
 
+def checkpoint_files(suffix):
+  ### checkpoints sorted by step, weights files (minmt-export.py) are preferred since they are memory-mapped
+  files = {}
+  for f in glob.glob("{}.checkpoint_????????.pt".format(suffix)) + glob.glob("{}.checkpoint_????????.weights".format(suffix)):
+    if checkpoint_step(f) not in files or f.endswith('.weights'):
+      files[checkpoint_step(f)] = f
+  return [files[step] for step in sorted(files)]
+
+def checkpoint_step(model_file):
+  ### network.checkpoint_STEP.pt or network.checkpoint_STEP.weights
+  return int(os.path.basename(model_file).split('_')[-1].split('.')[0])
+
+def load_model_tensors(model_file):
+  ### returns step and model tensors (the optimizer state is dropped as soon as loaded)
+  ### projections of older checkpoints (WQ/WK/WV) are fused (WQKV): checkpoints of both layouts can be averaged
+  if is_weights_file(model_file):
+    step, model = load_weights(model_file)
+    return step, fuse_projections(dict(model))
+  m = torch.load(model_file, map_location='cpu')
+  m.pop('optimizer', None) ### torch.load reads the whole checkpoint (no memory-mapping in torch 1.x)
+  return m['step'], fuse_projections(m['model'])
+
 ######################################################################
 ### MAIN #############################################################
 ######################################################################
@@ -57,28 +115,40 @@ if __name__ == '__main__':
   tic = time.time()
   o = Options(sys.argv)
 
-  model_files = sorted(glob.glob("{}.checkpoint_????????.pt".format(o.dnet + '/network'))) ### I check if there is one model
+  model_files = checkpoint_files(o.dnet + '/network') ### I check if there is one model
+  model_files = [f for f in model_files if checkpoint_step(f) >= o.first_step and (o.last_step == 0 or checkpoint_step(f) <= o.last_step)]
+  if len(o.steps):
+    model_files = [f for f in model_files if checkpoint_step(f) in o.steps]
+  if o.last_n:
+    model_files = model_files[-o.last_n:]
   if len(model_files) == 0:
     logging.error('No checkpoint found')
     sys.exit()
 
-  avg_model = None
+  ### sum (float64) model tensors while the next checkpoint is loaded
+  sum_model = None
   final_step = 0
-  for i, model_file in enumerate(model_files):
-    m = torch.load(model_file, map_location='cpu')
-    model = m['model']
-    step = m['step']
-    logging.info('Loading checkpoint step={} file={}'.format(step,model_file))
-    if step > final_step:
-      final_step = step 
-    if i == 0:
-      avg_model = model
-    else:
-      for (k, v) in avg_model.items():
-        avg_model[k].mul_(i).add_(model[k]).div_(i + 1)
+  with ThreadPoolExecutor(max_workers=1) as loader:
+    next_model = loader.submit(load_model_tensors, model_files[0])
+    for i, model_file in enumerate(model_files):
+      step, model = next_model.result()
+      if i+1 < len(model_files):
+        next_model = loader.submit(load_model_tensors, model_files[i+1])
+      logging.info('Loading checkpoint step={} file={}'.format(step,model_file))
+      if step > final_step:
+        final_step = step
+      if sum_model is None:
+        sum_model = {k: v.to(torch.float64) if v.is_floating_point() else v.clone() for k, v in model.items()}
+      else:
+        for k, v in sum_model.items():
+          if v.is_floating_point():
+            v.add_(model[k])
+      del model
+  avg_model = {k: v.div_(len(model_files)).to(torch.float32) if v.is_floating_point() else v for k, v in sum_model.items()}
   #dump averaged network
   final = {"model": avg_model, "step": final_step}
   torch.save(final, "{}.checkpoint_{:08d}_average.pt".format(o.dnet+'/network',final_step))
+  logging.info('Averaged {} checkpoints'.format(len(model_files)))
 
   toc = time.time()
   logging.info('Done ({:.2f} seconds)'.format(toc-tic))
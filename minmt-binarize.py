@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import logging
+from transformer.Dataset import Vocab, binarize
+from tools.Tools import create_logger
+
+######################################################################
+### Options ##########################################################
+######################################################################
+
+class Options():
+  def __init__(self, argv):
+    self.prog = argv.pop(0)
+    self.voc = None
+    self.input = None
+    self.output = None
+    log_file = 'stderr'
+    log_level = 'info'
+
+    while len(argv):
+      tok = argv.pop(0)
+      if tok=="-h":
+        self.usage()
+      elif tok=="-voc" and len(argv):
+        self.voc = argv.pop(0)
+      elif tok=="-i" and len(argv):
+        self.input = argv.pop(0)
+      elif tok=="-o" and len(argv):
+        self.output = argv.pop(0)
+      elif tok=="-log_file" and len(argv):
+        log_file = argv.pop(0)
+      elif tok=="-log_level" and len(argv):
+        log_level = argv.pop(0)
+
+      else:
+        self.usage('Unrecognized {} option'.format(tok))
+
+    if self.voc is None:
+      self.usage('missing -voc option')
+    if self.input is None:
+      self.usage('missing -i option')
+    if self.output is None:
+      self.output = self.input + '.bin'
+    create_logger(log_file,log_level)
+
+  def usage(self, messg=None):
+    if messg is not None:
+      sys.stderr.write(messg + '\n')
+    sys.stderr.write('''usage: {} -voc FILE -i FILE [-o PREFIX]
+   -voc        FILE : vocabulary of input file (DIR/src_voc or DIR/tgt_voc)
+   -i          FILE : input (tokenised) text file
+   -o        PREFIX : output binarized corpus (FILE.bin)
+
+   -log_file   FILE : log file  (stderr)
+   -log_level   STR : log level [debug, info, warning, critical, error] (info)
+   -h               : this help
+
+Writes PREFIX.ids.npy (token ids), PREFIX.offsets.npy (start of each line) and PREFIX.counts.npy (token frequencies), use PREFIX
+in place of the text file in minmt-train.py (-src_train, -tgt_train, -pre_train, ...)
+Token ids depend on the vocabulary: binarize again if it changes.
+'''.format(self.prog))
+    sys.exit()
+
+######################################################################
+### MAIN #############################################################
+######################################################################
+
+if __name__ == '__main__':
+
+  tic = time.time()
+  o = Options(sys.argv)
+  voc = Vocab(o.voc)
+  n_lines, n_tok, n_unk = binarize(o.input, voc, o.output)
+  logging.info('Binarized {} ({} lines ~ {} tokens ~ {} OOVs [{:.2f}%]) into {}.ids.npy {}.offsets.npy'.format(o.input, n_lines, n_tok, n_unk, 100.0*n_unk/max(1,n_tok), o.output, o.output))
+
+  toc = time.time()
+  logging.info('Done ({:.2f} seconds)'.format(toc-tic))
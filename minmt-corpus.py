@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import time
+import shutil
+import itertools
+import logging
+import multiprocessing
+import numpy as np
+from transformer.Dataset import Vocab, ids_dtype, write_binarized
+from tools.Tools import create_logger
+
+######################################################################
+### Options ##########################################################
+######################################################################
+
+class Options():
+  def __init__(self, argv):
+    self.prog = argv.pop(0)
+    self.input = None
+    self.output = None
+    self.domains = None
+    self.exts = ['src', 'tgt', 'sim', 'pre']
+    self.keep_empty = False
+    self.max_length = 0
+    self.src_voc = None
+    self.tgt_voc = None
+    self.procs = os.cpu_count()
+    log_file = 'stderr'
+    log_level = 'info'
+
+    while len(argv):
+      tok = argv.pop(0)
+      if tok=="-h":
+        self.usage()
+      elif tok=="-i" and len(argv):
+        self.input = argv.pop(0)
+      elif tok=="-o" and len(argv):
+        self.output = argv.pop(0)
+      elif tok=="-domains" and len(argv):
+        self.domains = argv.pop(0).split(',')
+      elif tok=="-keep_empty":
+        self.keep_empty = True
+      elif tok=="-max_length" and len(argv):
+        self.max_length = int(argv.pop(0))
+      elif tok=="-src_voc" and len(argv):
+        self.src_voc = argv.pop(0)
+      elif tok=="-tgt_voc" and len(argv):
+        self.tgt_voc = argv.pop(0)
+      elif tok=="-procs" and len(argv):
+        self.procs = int(argv.pop(0))
+      elif tok=="-log_file" and len(argv):
+        log_file = argv.pop(0)
+      elif tok=="-log_level" and len(argv):
+        log_level = argv.pop(0)
+
+      else:
+        self.usage('Unrecognized {} option'.format(tok))
+
+    if self.input is None or '{ext}' not in self.input:
+      self.usage('missing -i option (with {ext})')
+    if self.output is None or '{ext}' not in self.output:
+      self.usage('missing -o option (with {ext})')
+    if self.domains is None:
+      self.domains = ['']
+    if (self.src_voc is None) != (self.tgt_voc is None):
+      self.usage('binarized outputs need both -src_voc and -tgt_voc options')
+    create_logger(log_file,log_level)
+    logging.info("Options = {}".format(self.__dict__))
+
+  def usage(self, messg=None):
+    if messg is not None:
+      sys.stderr.write(messg + '\n')
+    sys.stderr.write('''usage: {} -i PATTERN -o PATTERN [-domains STRING] [Options]
+   -i       PATTERN : input files, {{domain}} and {{ext}} (src, tgt, sim, pre) are replaced in PATTERN
+   -o       PATTERN : output files, {{ext}} (src, tgt, sim, pre) is replaced in PATTERN
+   -domains  STRING : comma-separated domains, concatenated in this order in output files
+
+   -keep_empty      : keep examples with empty similarity (sim) line, spaces are not empty ({})
+   -max_length  INT : skip example if number of src/tgt/pre tokens exceeds this, 0 for no limit ({})
+   -src_voc    FILE : source vocabulary, src output is binarized (needs -tgt_voc)
+   -tgt_voc    FILE : target vocabulary, tgt and pre outputs are binarized (needs -src_voc)
+   -procs       INT : number of processes, each one filters a domain at a time ({})
+
+   -log_file   FILE : log file  (stderr)
+   -log_level   STR : log level [debug, info, warning, critical, error] (info)
+   -h               : this help
+
+Files src/tgt/sim/pre of each domain are read in lockstep (single pass) and lines of examples kept are
+written in output files, binarized outputs (see minmt-binarize.py) are used as PREFIX in minmt-train.py.
+Lines end with '\n' only, a newline is added to the last line of a file lacking it (not joined to the next domain).
+Example:
+  {} -i clean.{{domain}}.en-fr.en.trn.bpe.vec.max_sim0.5_k5_n0_t0.8.{{ext}} -o data_corpus/trn_{{ext}}_plein -domains ECB,EMEA,Europarl
+'''.format(self.prog, self.keep_empty, self.max_length, self.procs, self.prog))
+    sys.exit()
+
+######################################################################
+### Filter ###########################################################
+######################################################################
+
+def part_file(o, ext, d):
+  ### output of domain d (concatenated in order once all domains are done)
+  return '{}.part{}'.format(o.output.format(ext=ext), d)
+
+def filter_domain(o, vocs, d, domain, chunk_size=100000):
+  ### writes the examples of domain kept in part files (text, or token ids and lengths if binarized)
+  ### returns (read, kept, empty, long) number of examples
+  fins = [open(o.input.format(domain=domain, ext=ext), 'r', encoding='utf-8', newline='\n') for ext in o.exts] ### lines end with '\n' only (as in Dataset)
+  fouts = [open(part_file(o, ext, d), 'w' if vocs[ext] is None else 'wb', encoding='utf-8' if vocs[ext] is None else None) for ext in o.exts]
+  flens = {ext:open(part_file(o, ext, d) + '.lens', 'wb') for ext in o.exts if vocs[ext] is not None}
+  n_read, n_kept, n_empty, n_long = 0, 0, 0, 0
+  rows = [] ### lines of examples kept (encoded chunk_size at a time when binarized)
+  for lines in itertools.zip_longest(*fins):
+    if None in lines:
+      raise ValueError('Non-parallel files in domain {} (different number of lines)'.format(domain))
+    n_read += 1
+    ex = dict(zip(o.exts, lines))
+    if not o.keep_empty and ex['sim'] in ('\n', ''):
+      n_empty += 1
+      continue
+    if o.max_length and max([len(ex[ext].split()) for ext in ['src', 'tgt', 'pre']]) > o.max_length:
+      n_long += 1
+      continue
+    n_kept += 1
+    rows.append(lines)
+    if len(rows) == chunk_size:
+      write_rows(o, vocs, rows, fouts, flens)
+      rows = []
+  write_rows(o, vocs, rows, fouts, flens)
+  for f in fins + fouts + list(flens.values()):
+    f.close()
+  return n_read, n_kept, n_empty, n_long
+
+def write_rows(o, vocs, rows, fouts, flens):
+  for e, ext in enumerate(o.exts):
+    lines = [row[e] for row in rows]
+    if vocs[ext] is None: ### last line of a file may lack its newline
+      fouts[e].writelines([l if l.endswith('\n') else l + '\n' for l in lines])
+      continue
+    idxs = vocs[ext].encode_lines(lines)
+    lens = np.array([len(l) for l in idxs], dtype=np.int64)
+    np.fromiter(itertools.chain.from_iterable(idxs), dtype=ids_dtype(vocs[ext]), count=int(lens.sum())).tofile(fouts[e])
+    lens.tofile(flens[ext])
+
+def remove_parts(o):
+  ### removes the part files left by domains (failed)
+  for ext in o.exts:
+    for d in range(len(o.domains)):
+      for part in [part_file(o, ext, d), part_file(o, ext, d) + '.lens']:
+        if os.path.isfile(part):
+          os.remove(part)
+
+def merge_parts(o, vocs):
+  ### concatenates the part files of all domains in output files
+  for ext in o.exts:
+    fout = o.output.format(ext=ext)
+    parts = [part_file(o, ext, d) for d in range(len(o.domains))]
+    if vocs[ext] is None:
+      with open(fout, 'wb') as fd:
+        for part in parts:
+          with open(part, 'rb') as fp:
+            shutil.copyfileobj(fp, fd)
+    else:
+      dtype = ids_dtype(vocs[ext])
+      lens = np.concatenate([np.fromfile(part + '.lens', dtype=np.int64) for part in parts])
+      chunks = (np.memmap(part, dtype=dtype, mode='r') for part in parts if os.path.getsize(part))
+      counts = write_binarized(fout, chunks, lens, len(vocs[ext]), dtype)
+      logging.info('Binarized {} ({} lines ~ {} tokens ~ {} OOVs [{:.2f}%])'.format(fout, len(lens), counts.sum(), counts[vocs[ext].idx_unk], 100.0*counts[vocs[ext].idx_unk]/max(1,counts.sum())))
+      for part in parts:
+        os.remove(part + '.lens')
+    for part in parts:
+      os.remove(part)
+
+######################################################################
+### MAIN #############################################################
+######################################################################
+
+if __name__ == '__main__':
+
+  tic = time.time()
+  o = Options(sys.argv)
+  vocs = {ext:None for ext in o.exts}
+  if o.src_voc is not None:
+    vocs['src'] = Vocab(o.src_voc)
+    vocs['tgt'] = vocs['pre'] = Vocab(o.tgt_voc)
+
+  tasks = [(o, vocs, d, domain) for d, domain in enumerate(o.domains)]
+  try:
+    if o.procs > 1 and len(tasks) > 1:
+      with multiprocessing.get_context('fork').Pool(min(o.procs, len(tasks))) as pool: ### workers are terminated on error
+        results = pool.starmap(filter_domain, tasks)
+    else:
+      results = [filter_domain(*task) for task in tasks]
+  except (ValueError, OSError) as e:
+    remove_parts(o)
+    logging.error(str(e))
+    sys.exit(1)
+  for domain, (n_read, n_kept, n_empty, n_long) in zip(o.domains, results):
+    logging.info('Domain {}: {} examples read ~ {} kept ~ {} with empty sim ~ {} too long'.format(domain, n_read, n_kept, n_empty, n_long))
+
+  merge_parts(o, vocs)
+  n_read, n_kept = sum([r[0] for r in results]), sum([r[1] for r in results])
+  logging.info('Built corpus ({} examples kept out of {}) in {}'.format(n_kept, n_read, o.output))
+
+  toc = time.time()
+  logging.info('Done ({:.2f} seconds)'.format(toc-tic))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import time
+import sys
+import os
+import glob
+import torch
+import logging
+from tools.Tools import create_logger
+from transformer.Model import export_weights
+
+######################################################################
+### Options ##########################################################
+######################################################################
+
+class Options():
+  def __init__(self, argv):
+    self.prog = argv.pop(0)
+    self.dnet = None
+    self.model = None
+    self.output = None
+    self.dtype = 'float32'
+
+    log_file = 'stderr'
+    log_level = 'info'
+
+    while len(argv):
+      tok = argv.pop(0)
+      if tok=="-h":
+        self.usage()
+      elif tok=="-dnet" and len(argv):
+        self.dnet = argv.pop(0)
+      elif tok=="-m" and len(argv):
+        self.model = argv.pop(0)
+      elif tok=="-o" and len(argv):
+        self.output = argv.pop(0)
+      elif tok=="-dtype" and len(argv):
+        self.dtype = argv.pop(0)
+      elif tok=="-log_file" and len(argv):
+        log_file = argv.pop(0)
+      elif tok=="-log_level" and len(argv):
+        log_level = argv.pop(0)
+
+      else:
+        self.usage('Unrecognized {} option'.format(tok))
+
+    create_logger(log_file,log_level)
+    if self.dnet is None:
+      logging.error('missing -dnet option')
+      self.usage()
+    if self.dtype not in ['float32', 'float16', 'bfloat16']:
+      logging.error('bad -dtype option')
+      self.usage()
+
+  def usage(self, messg=None):
+    if messg is not None:
+      sys.stderr.write(messg + '\n')
+    sys.stderr.write('''usage: {} -dnet DIR [Options]
+   -dnet         DIR : network directory
+   -m           FILE : checkpoint to export (last checkpoint)
+   -o           FILE : output weights file (DIR/network.checkpoint_STEP.weights)
+   -dtype        STR : storage type of weights: float32, float16, bfloat16 ({})
+                       [reduced precision weights are upcast to float32 when loaded]
+
+   -log_file    FILE : log file  (stderr)
+   -log_level    STR : log level [debug, info, warning, critical, error] (info)
+   -h                : this help
+
+Exports model weights only (no optimizer state) for inference, use it with: minmt-translate.py -m FILE
+'''.format(self.prog, self.dtype))
+    sys.exit()
+
+######################################################################
+### MAIN #############################################################
+######################################################################
+            
+if __name__ == '__main__':
+
+  tic = time.time()
+  o = Options(sys.argv)
+
+  if o.model is None:
+    model_files = sorted(glob.glob("{}.checkpoint_????????.pt".format(o.dnet + '/network'))) ### I check if there is one model
+    if len(model_files) == 0:
+      logging.error('No checkpoint found')
+      sys.exit()
+    o.model = model_files[-1] ### last is the newest
+
+  m = torch.load(o.model, map_location='cpu')
+  logging.info('Loaded checkpoint step={} file={}'.format(m['step'],o.model))
+  if o.output is None:
+    o.output = "{}.checkpoint_{:08d}.weights".format(o.dnet+'/network',m['step'])
+  export_weights(o.output, m['model'], m['step'], getattr(torch, o.dtype))
+
+  toc = time.time()
+  logging.info('Done ({:.2f} seconds)'.format(toc-tic))
@@ -1,6 +1,7 @@
 import sys
 import os
 import time
+import socket
 import random
 import logging
 import torch
@@ -11,8 +12,6 @@ from transformer.Optimizer import OptScheduler, LabelSmoothing_NLL, LabelSmoothi
 from transformer.Learning import Learning
 from tools.Tools import create_logger, read_dnet
 
-sys.stderr = open('error_serie_true.log', 'w')
-
 ######################################################################
 ### Options ##########################################################
 ######################################################################
@@ -29,9 +28,11 @@ class Options():
         self.max_steps = 0
         self.max_epochs = 0
         self.validate_every = 5000
+        self.validate_async = False
         self.save_every = 5000
         self.report_every = 100
         self.keep_last_n = 5
+        self.max_async_saves = 1
         self.mask_prefix = False
         ### optim
         self.noam_scale = 2.0
@@ -39,13 +40,24 @@ class Options():
         self.label_smoothing = 0.1
         self.loss = 'NLL'
         self.clip = 0.5
+        self.checkpoint_activations = ''
+        self.profile_steps = ''
+        self.accum_steps = 1
+        self.accum_tokens = 0
         ### data
         self.shard_size = 500000
+        self.stream = False
+        self.shuffle_shards = 2
         self.max_length = 100
+        self.bucket_width = 0
+        self.cache_batchs = False
+        self.data_procs = os.cpu_count()
         self.batch_size = 4096*2
         self.batch_type = 'tokens'
 
         self.cuda = False
+        self.nproc = 1
+        self.master_port = 0
         self.seed = 12345
         log_file = 'stderr'
         log_level = 'info'
@@ -64,12 +76,16 @@ class Options():
                 self.max_epochs = int(argv.pop(0))
             elif tok == '-validate_every':
                 self.validate_every = int(argv.pop(0))
+            elif tok == '-validate_async':
+                self.validate_async = True
             elif tok == '-save_every':
                 self.save_every = int(argv.pop(0))
             elif tok == '-report_every':
                 self.report_every = int(argv.pop(0))
             elif tok == '-keep_last_n':
                 self.keep_last_n = int(argv.pop(0))
+            elif tok == '-max_async_saves':
+                self.max_async_saves = int(argv.pop(0))
             elif tok == '-mask_prefix':
                 self.mask_prefix = True
             elif tok == '-noam_scale':
@@ -82,6 +98,14 @@ class Options():
                 self.loss = argv.pop(0)
             elif tok == '-clip':
                 self.clip = float(argv.pop(0))
+            elif tok == '-checkpoint_activations':
+                self.checkpoint_activations = argv.pop(0)
+            elif tok == '-profile_steps':
+                self.profile_steps = argv.pop(0)
+            elif tok == '-accum_steps':
+                self.accum_steps = int(argv.pop(0))
+            elif tok == '-accum_tokens':
+                self.accum_tokens = int(argv.pop(0))
 
             elif tok == '-src_train':
                 self.src_train = argv.pop(0)
@@ -99,8 +123,18 @@ class Options():
                 self.tgt_valid = argv.pop(0)
             elif tok == '-shard_size':
                 self.shard_size = int(argv.pop(0))
+            elif tok == '-stream':
+                self.stream = True
+            elif tok == '-shuffle_shards':
+                self.shuffle_shards = int(argv.pop(0))
             elif tok == '-max_length':
                 self.max_length = int(argv.pop(0))
+            elif tok == '-bucket_width':
+                self.bucket_width = int(argv.pop(0))
+            elif tok == '-cache_batchs':
+                self.cache_batchs = True
+            elif tok == '-data_procs':
+                self.data_procs = int(argv.pop(0))
             elif tok == '-batch_size':
                 self.batch_size = int(argv.pop(0))
             elif tok == '-batch_type':
@@ -108,6 +142,10 @@ class Options():
 
             elif tok == "-cuda":
                 self.cuda = True
+            elif tok == "-nproc":
+                self.nproc = int(argv.pop(0))
+            elif tok == "-master_port":
+                self.master_port = int(argv.pop(0))
             elif tok == "-seed":
                 self.seed = int(argv.pop(0))
             elif tok == "-log_file" and len(argv):
@@ -139,13 +177,16 @@ class Options():
    -tgt_train        FILE : target-side training file
    -src_valid        FILE : source-side validation file
    -tgt_valid        FILE : target-side validation file
+                            [data files are text or binarized corpora built by minmt-binarize.py]
    [Learning]
    -max_steps         INT : maximum number of training updates ({})
    -max_epochs        INT : maximum number of training epochs ({})
    -validate_every    INT : validation every INT model updates ({})
+   -validate_async        : validate in a background process (learning goes on) ({})
    -save_every        INT : save model every INT model updates ({})
    -report_every      INT : report every INT model updates ({})
    -keep_last_n       INT : save last INT checkpoints ({})
+   -max_async_saves   INT : max checkpoints written in background at a time, 0 for synchronous saves ({})
    -mask_prefix           : mask prefix tokens not appearing in target ({})
    [Optimization]
    -label_smoothing FLOAT : label smoothing probability ({})
@@ -153,19 +194,30 @@ class Options():
    -clip            FLOAT : clips gradient norm of parameters ({})
    -noam_scale      FLOAT : scale of Noam decay for learning rate ({})
    -noam_warmup       INT : warmup steps of Noam decay for learning rate ({})
+   -checkpoint_activations STRING : comma-separated stacks (src,pre,tgt) whose activations are recomputed in backward ({})
+   -accum_steps       INT : accumulate gradients of INT batches before each update ({})
+   -accum_tokens      INT : accumulate gradients until INT target tokens before each update, overrides -accum_steps ({})
+   -profile_steps     A:B : profile updates A to B (torch.profiler), chrome trace and top ops are saved in DIR ({})
    [Data]
    -shard_size        INT : maximum shard size ({}) use 0 to consider all data in a single shard
+   -stream                : read training data from disk one shard at a time (memory bounded by -shard_size) ({})
+   -shuffle_shards    INT : number of shards read and shuffled together when streaming ({})
    -max_length        INT : skip example if number of tokens exceeds this ({})
+   -bucket_width      INT : batch examples with lengths (src, tgt, pre) in the same buckets of INT tokens (e.g. 8), 0 to sort by source length only ({})
+   -cache_batchs          : save batch plans of shards (and the projected padding) in DIR/batchs, loaded instead of rebuilt when files and batching options are unchanged ({})
+   -data_procs        INT : number of processes encoding text data files ({})
    -batch_size        INT : maximum batch size ({})
    -batch_type     STRING : sentences or tokens ({})
    -cuda                  : use cuda device instead of cpu ({})
+   -nproc             INT : number of local learning processes (torch.distributed with gloo backend) ({})
+   -master_port       INT : port used by the learning processes to communicate, 0 for MASTER_PORT or else a free port ({})
    -seed              INT : seed for randomness ({})
    -log_file         FILE : log file  (stderr)
    -log_level      STRING : log level [debug, info, warning, critical, error] (info)
    -h                     : this help
-'''.format(self.prog, self.max_steps, self.max_epochs, self.validate_every, self.save_every, self.report_every,
-           self.keep_last_n, self.mask_prefix, self.label_smoothing, self.loss, self.clip, self.noam_scale,
-           self.noam_warmup, self.shard_size, self.max_length, self.batch_size, self.batch_type, self.cuda, self.seed))
+'''.format(self.prog, self.max_steps, self.max_epochs, self.validate_every, self.validate_async, self.save_every, self.report_every,
+           self.keep_last_n, self.max_async_saves, self.mask_prefix, self.label_smoothing, self.loss, self.clip, self.noam_scale,
+           self.noam_warmup, self.checkpoint_activations, self.accum_steps, self.accum_tokens, self.profile_steps, self.shard_size, self.stream, self.shuffle_shards, self.max_length, self.bucket_width, self.cache_batchs, self.data_procs, self.batch_size, self.batch_type, self.cuda, self.nproc, self.master_port, self.seed))
         sys.exit()
 
 
@@ -173,20 +225,23 @@ class Options():
 ### MAIN #############################################################
 ######################################################################
 
-if __name__ == '__main__':
-
-    tic = time.time()
-    o = Options(sys.argv)
-    n, src_voc, tgt_voc = read_dnet(o.dnet)
-    src_voc = Vocab(src_voc)
-    tgt_voc = Vocab(tgt_voc)
-
-    #####################################################
-    ####     a verif
-    #####################################################
-
-    tgt_voc = tgt_voc
+def free_port():
+    ### a port not in use on this host (jobs running on the same host do not collide)
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
 
+def train_process(rank, o, n_procs, n, src_voc, tgt_voc, train, valid):
+    ### runs learning in one process (rank) out of n_procs
+    if n_procs > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')  ### MASTER_PORT is set before forking (see free_port)
+        torch.distributed.init_process_group('gloo', rank=rank, world_size=n_procs)
+        torch.set_num_threads(max(1, torch.get_num_threads() // n_procs))
+        torch.manual_seed(o.seed + rank)  ### different dropout in each process
+        train.rank, train.n_ranks = rank, n_procs  ### each process traverses a disjoint slice of batchs
+        if rank > 0:
+            logging.getLogger().setLevel(logging.WARNING)
+        logging.info('Initialized process group (gloo) with {} processes'.format(n_procs))
 
     ########################
     ### load model/optim ###
@@ -197,9 +252,11 @@ if __name__ == '__main__':
     logging.info(
         'Built model (#params, size) = ({}) in device {}'.format(', '.join([str(f) for f in numparameters(model)]),
                                                                  next(model.parameters()).device))
+    if o.checkpoint_activations:
+        model.checkpoint_activations(o.checkpoint_activations.split(','))
     optim = torch.optim.Adam(model.parameters(), weight_decay=n['weight_decay'], betas=(n['beta1'], n['beta2']),
                              eps=n['eps'])
-    last_step, model, optim = load_checkpoint(o.dnet + '/network', model, optim, device)
+    last_step, model, optim = load_checkpoint(o.dnet + '/network', model, optim, device, train)
 
     ############################
     ### build scheduler/loss ###
@@ -213,25 +270,57 @@ if __name__ == '__main__':
         logging.error('bad -loss option')
         sys.exit()
 
+    #############
+    ### learn ###
+    #############
+    learning = Learning(model, optScheduler, criter, o.dnet + '/network', src_voc.idx_pad, tgt_voc.idx_sep,
+                        tgt_voc.idx_msk, o)
+    learning.learn(train, valid, device)
+
+    if n_procs > 1:
+        torch.distributed.destroy_process_group()
+
+
+if __name__ == '__main__':
+
+    sys.stderr = open('error_serie_true.log', 'w')
+    tic = time.time()
+    o = Options(list(sys.argv)) ### sys.argv is kept for spawned processes
+    n, src_voc, tgt_voc = read_dnet(o.dnet)
+    src_voc = Vocab(src_voc)
+    tgt_voc = Vocab(tgt_voc)
+
+    #####################################################
+    ####     a verif
+    #####################################################
+
+    tgt_voc = tgt_voc
+
     ##################
     ### load data ####
     ##################
+    cache_dir = o.dnet + '/batchs' if o.cache_batchs else None
     valid = None
     if o.src_valid is not None and o.tgt_valid is not None:
         # valid = Dataset([src_voc, tgt_voc], [o.src_valid, o.tgt_valid], o.shard_size, o.batch_size, o.batch_type, o.max_length)
         valid = Dataset([src_voc, tgt_voc, tgt_voc], [o.src_valid, o.tgt_valid,  o.pre_valid], o.shard_size, o.batch_size, o.batch_type,
-                        o.max_length)
+                        o.max_length, shuffle=False, bucket_width=o.bucket_width, cache_dir=cache_dir, n_procs=o.data_procs)
     #train = Dataset([src_voc, tgt_voc], [o.src_train, o.tgt_train], o.shard_size, o.batch_size, o.batch_type, o.max_length)
 
     train = Dataset([src_voc, tgt_voc,  tgt_voc], [o.src_train, o.tgt_train,  o.pre_train],
-                    o.shard_size, o.batch_size, o.batch_type, o.max_length)
+                    o.shard_size, o.batch_size, o.batch_type, o.max_length, stream=o.stream, shuffle_shards=o.shuffle_shards, bucket_width=o.bucket_width, cache_dir=cache_dir, n_procs=o.data_procs)
 
     #############
     ### learn ###
     #############
-    learning = Learning(model, optScheduler, criter, o.dnet + '/network', src_voc.idx_pad, tgt_voc.idx_sep,
-                        tgt_voc.idx_msk, o)
-    learning.learn(train, valid, device)
+    if o.nproc > 1:
+        ### data is loaded once and shared (fork) by all learning processes
+        os.environ['MASTER_PORT'] = str(o.master_port or os.environ.get('MASTER_PORT') or free_port())
+        logging.info('Learning processes communicate through port {}'.format(os.environ['MASTER_PORT']))
+        torch.multiprocessing.start_processes(train_process, args=(o, o.nproc, n, src_voc, tgt_voc, train, valid),
+                                              nprocs=o.nproc, start_method='fork')
+    else:
+        train_process(0, o, 1, n, src_voc, tgt_voc, train, valid)
 
     toc = time.time()
     logging.info('Done ({:.2f} seconds)'.format(toc - tic))
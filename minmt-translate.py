@@ -7,7 +7,7 @@ import logging
 import torch
 #import yaml
 from transformer.Dataset import Dataset, Vocab
-from transformer.Model import Encoder_Decoder, load_model, numparameters
+from transformer.Model import Encoder_Decoder, load_model, numparameters, no_init
 from transformer.Inference import Inference
 from tools.Tools import create_logger, read_dnet
 
@@ -33,7 +33,9 @@ class Options():
     self.mask_prefix = False
     self.batch_size = 30
     self.batch_type = 'sentences'    
+    self.cache_batchs = False
     self.cuda = False
+    self.profile_steps = ''
     log_file = 'stderr'
     log_level = 'info'
 
@@ -73,11 +75,15 @@ class Options():
         self.batch_size = int(argv.pop(0))
       elif tok=='-batch_type' and len(argv):
         self.batch_type = argv.pop(0)
+      elif tok=='-cache_batchs':
+        self.cache_batchs = True
       elif tok=='-mask_prefix':
         self.mask_prefix = True
 
       elif tok=="-cuda":
         self.cuda = True
+      elif tok=="-profile_steps" and len(argv):
+        self.profile_steps = argv.pop(0)
       elif tok=="-log_file" and len(argv):
         log_file = argv.pop(0)
       elif tok=="-log_level" and len(argv):
@@ -101,7 +107,7 @@ class Options():
    -dnet          DIR : network directory [must exist]
    -p            FILE : file with prefixs for input file (force decoding)
    -o            FILE : output file ({})
-   -m            FILE : use this model file (last checkpoint)
+   -m            FILE : use this model file (last checkpoint) [checkpoint or weights file built by minmt-export.py]
 
    [Inference]
    -beam_size     INT : size of beam ({})
@@ -122,12 +128,14 @@ class Options():
    -max_length    INT : skip example if number of (src/tgt) tokens exceeds this ({})
    -batch_size    INT : maximum batch size ({})
    -batch_type STRING : sentences or tokens ({})
+   -cache_batchs      : save batch plans in DIR/batchs, loaded instead of rebuilt when input files and batching options are unchanged ({})
 
    -cuda              : use cuda device instead of cpu ({})
+   -profile_steps A:B : profile batchs A to B (torch.profiler), chrome trace and top ops are saved in DIR ({})
    -log_file     FILE : log file  (stderr)
    -log_level  STRING : log level [debug, info, warning, critical, error] (info)
    -h                 : this help
-'''.format(self.prog, self.output, self.beam_size, self.n_best, self.max_size, self.alpha, self.format, self.shard_size, self.max_length, self.batch_size, self.batch_type, self.cuda))
+'''.format(self.prog, self.output, self.beam_size, self.n_best, self.max_size, self.alpha, self.format, self.shard_size, self.max_length, self.batch_size, self.batch_type, self.cache_batchs, self.cuda, self.profile_steps))
     sys.exit()
 
 ######################################################################
@@ -146,7 +154,8 @@ if __name__ == '__main__':
   ### load model ###
   ##################
   device = torch.device('cuda' if o.cuda and torch.cuda.is_available() else 'cpu')
-  model = Encoder_Decoder(n['n_layers'], n['ff_dim'], n['n_heads'], n['emb_dim'], n['qk_dim'], n['v_dim'], n['dropout'], n['share_embeddings'], len(src_voc), len(tgt_voc), src_voc.idx_pad).to(device)
+  with no_init(): ### weights are loaded afterwards
+    model = Encoder_Decoder(n['n_layers'], n['ff_dim'], n['n_heads'], n['emb_dim'], n['qk_dim'], n['v_dim'], n['dropout'], n['share_embeddings'], len(src_voc), len(tgt_voc), src_voc.idx_pad).to(device)
   logging.info('Built model (#params, size) = ({}) in device {}'.format(', '.join([str(f) for f in numparameters(model)]), next(model.parameters()).device ))
   step, model = load_model(o.dnet + '/network', model, device, o.model)
 
@@ -154,7 +163,7 @@ if __name__ == '__main__':
   ### load test ####
   ##################
 
-  test = Dataset([src_voc, src_voc, tgt_voc], [o.input_src, o.input_pre], shard_size=o.shard_size, batch_size=o.batch_size, batch_type=o.batch_type, max_length=o.max_length, shuffle=False)
+  test = Dataset([src_voc, tgt_voc], [o.input_src, o.input_pre], shard_size=o.shard_size, batch_size=o.batch_size, batch_type=o.batch_type, max_length=o.max_length, shuffle=False, cache_dir=os.path.join(o.dnet, 'batchs') if o.cache_batchs else None)
 
   ##################
   ### Inference ####
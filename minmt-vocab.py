@@ -1,19 +1,84 @@
 #!/usr/bin/env python3
 
 import sys
+import os
+import itertools
 import logging
+import multiprocessing
+from collections import Counter, deque
 from tools.Tools import create_logger
-from collections import Counter
+from transformer.Dataset import chunk_offsets
+
+######################################################################
+### Counting #########################################################
+######################################################################
+### files (or stdin) are split in line-aligned chunks counted by a pool of processes, counters
+### are merged in chunk order: same counts and same order of first appearance than a single pass
+
+def count_chunk(chunk):
+  ### chunk is either text (read from stdin) or (file, start, end) a range of bytes of file
+  if isinstance(chunk, str):
+    return Counter(chunk.split())
+  ftxt, start, end = chunk
+  with open(ftxt, 'rb') as fd:
+    fd.seek(start)
+    return Counter(fd.read(end-start).decode('utf-8').split())
+
+def chunks(files, chunk_size, chunk_lines):
+  for ftxt in files:
+    offsets = chunk_offsets(ftxt, chunk_size)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+      yield ftxt, start, end
+  if len(files) == 0:
+    while True:
+      lines = list(itertools.islice(sys.stdin, chunk_lines))
+      if len(lines) == 0:
+        break
+      yield ''.join(lines)
+
+def merge(freq, counts, max_entries):
+  freq.update(counts)
+  if max_entries and len(freq) > 2*max_entries:
+    ### keep the max_entries most frequent (approximate counts, tokens pruned may appear again)
+    keep = set([tok for tok, _ in freq.most_common(max_entries)])
+    for tok in [tok for tok in freq if tok not in keep]:
+      del freq[tok]
+
+def count_words(files, procs, max_entries, chunk_size=2**22, chunk_lines=100000):
+  freq = Counter()
+  if procs <= 1:
+    for chunk in chunks(files, chunk_size, chunk_lines):
+      merge(freq, count_chunk(chunk), max_entries)
+    return freq
+  with multiprocessing.get_context('fork').Pool(procs) as pool:
+    pending = deque() ### at most 2*procs chunks read and not merged (bounded memory)
+    for chunk in chunks(files, chunk_size, chunk_lines):
+      pending.append(pool.apply_async(count_chunk, (chunk,)))
+      if len(pending) >= 2*procs:
+        merge(freq, pending.popleft().get(), max_entries)
+    while len(pending):
+      merge(freq, pending.popleft().get(), max_entries)
+  return freq
+
+######################################################################
+### MAIN #############################################################
+######################################################################
 
 if __name__ == '__main__':
 
   max_size = 30000
   min_freq = 1
+  procs = os.cpu_count()
+  max_entries = 0
+  files = []
   prog = sys.argv.pop(0)
-  usage = '''usage: {} [-min_freq N] [-max_size N] < text > vocab
-   -min_freq INT : minimum frequence to keep a word, 1 keeps all (default {})
-   -max_size INT : maximum number of words in vocab, 0 keeps all (default {})
-   -h            : this help
+  usage = '''usage: {} [-min_freq N] [-max_size N] [-procs N] [-max_entries N] [FILE ...] > vocab
+   -min_freq    INT : minimum frequence to keep a word, 1 keeps all (default {})
+   -max_size    INT : maximum number of words in vocab, 0 keeps all (default {})
+   -procs       INT : number of counting processes (default {})
+   -max_entries INT : keep (about) the INT most frequent words while counting, bounded memory but approximate counts, 0 for exact counts (default {})
+   -h               : this help
+Words are counted in FILEs (stdin if none)
 Tokens always used:
 <pad>
 <unk>
@@ -21,7 +86,7 @@ Tokens always used:
 <eos>
 ⸨sep⸩
 ⸨msk⸩
-'''.format(prog,min_freq,max_size)
+'''.format(prog,min_freq,max_size,procs,max_entries)
 
   while len(sys.argv):
     tok = sys.argv.pop(0)
@@ -32,6 +97,12 @@ Tokens always used:
       min_freq = int(sys.argv.pop(0))
     elif tok=="-max_size":
       max_size = int(sys.argv.pop(0))
+    elif tok=="-procs":
+      procs = int(sys.argv.pop(0))
+    elif tok=="-max_entries":
+      max_entries = int(sys.argv.pop(0))
+    elif not tok.startswith('-') and os.path.isfile(tok):
+      files.append(tok)
 
     else:
       sys.stderr.write('Unrecognized {} option\n'.format(tok))
@@ -41,14 +112,14 @@ Tokens always used:
   create_logger(None, 'info')
   logging.info('min_freq = {}'.format(min_freq))
   logging.info('max_size = {}'.format(max_size))
+  logging.info('procs = {}'.format(procs))
+  logging.info('max_entries = {}'.format(max_entries))
+  logging.info('files = {}'.format(files if len(files) else 'stdin'))
 
   ###################
   ### count words ###
   ###################
-  lflat = []
-  ll = [l.split() for l in sys.stdin.readlines()]
-  list(map(lflat.extend, ll))
-  freq = Counter(lflat)
+  freq = count_words(files, procs, max_entries)
 
   #######################
   ### dump vocabulary ###
@@ -60,6 +131,7 @@ Tokens always used:
   print('⸨sep⸩')
   print('⸨msk⸩')
   n = 6
+  f = 0
   for tok, count in freq.most_common():
     if max_size and n >= max_size:
       break
@@ -71,5 +143,3 @@ Tokens always used:
     f = count
     n += 1
   logging.info('Dumped vocab with {} entries (lowest frequence is {})'.format(n,f))
-
-
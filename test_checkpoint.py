@@ -0,0 +1,33 @@
+import torch
+from transformer.Model import Encoder_Decoder, CheckpointSaver, save_checkpoint
+
+def build_model():
+  return Encoder_Decoder(2, 64, 4, 32, 8, 8, 0.1, True, 50, 50, 0) ### share_embeddings
+
+def shared(checkpoint):
+  return checkpoint['model']['src_emb.emb.weight'].data_ptr() == checkpoint['model']['tgt_emb.emb.weight'].data_ptr()
+
+def test_async_checkpoint_keeps_tied_weights_shared(tmp_path):
+  model = build_model()
+  optimizer = torch.optim.Adam(model.parameters())
+  suffix = str(tmp_path / 'network')
+  saver = CheckpointSaver(suffix, 0, max_inflight=1)
+  saver.save(model, optimizer, 20)
+  saver.wait()
+  checkpoint = torch.load(suffix + '.checkpoint_00000020.pt', map_location='cpu')
+  assert shared(checkpoint)
+  assert torch.equal(checkpoint['model']['src_emb.emb.weight'], model.src_emb.emb.weight.detach())
+
+def test_sync_and_async_checkpoints_agree(tmp_path):
+  model = build_model()
+  optimizer = torch.optim.Adam(model.parameters())
+  suffix = str(tmp_path / 'network')
+  save_checkpoint(suffix, model, optimizer, 0, 0)
+  saver = CheckpointSaver(suffix, 0, max_inflight=1)
+  saver.save(model, optimizer, 20)
+  saver.wait()
+  sync = torch.load(suffix + '.checkpoint_00000000.pt', map_location='cpu')
+  async_ = torch.load(suffix + '.checkpoint_00000020.pt', map_location='cpu')
+  assert shared(sync) and shared(async_)
+  assert sync['model'].keys() == async_['model'].keys()
+  assert all(torch.equal(sync['model'][k], async_['model'][k]) for k in sync['model'])
@@ -4,9 +4,12 @@ import sys
 import os
 import logging
 import codecs
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 from collections import defaultdict
-from tools.Tools import flatten_count
+from transformer.Statistics import token_counts, corpus_stats, log_stats, padding, padding_efficiency
 
 #######################################################
 ### Vocab #############################################
@@ -30,6 +33,7 @@ class Vocab():
     with codecs.open(fvoc, 'r', 'utf-8') as fd:
       self.idx_to_tok = [l for l in fd.read().splitlines()]
     self.tok_to_idx = {k:i for i,k in enumerate(self.idx_to_tok)}
+    self.tokens = np.array(self.idx_to_tok, dtype=object) ### idx => token (bulk decoding)
     assert self.tok_to_idx[self.str_pad] == 0, '<pad> must exist in vocab with id=0 while found id={}'.format(self.tok_to_idx[self.str_pad])
     assert self.tok_to_idx[self.str_unk] == 1, '<unk> must exist in vocab with id=1 while found id={}'.format(self.tok_to_idx[self.str_unk])
     assert self.tok_to_idx[self.str_bos] == 2, '<bos> must exist in vocab with id=2 while found id={}'.format(self.tok_to_idx[self.str_bos])
@@ -54,120 +58,244 @@ class Vocab():
     else:
       return self.idx_unk
 
+  def encode(self, line):
+    ### returns the ids (numpy array) of the tokens of line
+    return np.array(self.encode_lines([line])[0], dtype=np.int64)
 
-##############################################################################################################
-### Batch ####################################################################################################
-##############################################################################################################
-class Batch():
-  def __init__(self, batch_size, batch_type, n_files=2):
-    super(Batch, self).__init__()
-    self.batch_size = batch_size
-    self.batch_type = batch_type
-    self.n_files = n_files
-    self.idxs_pos = []
-    self.max_lens = [0] * n_files
-
-  def fits(self, lens):
-    ### returns True if a new example with lengths (lsrc, ltgt) can be added in this batch; False otherwise
-    if self.batch_type == 'tokens':
-      for n in range(self.n_files):
-        if max(lens[n],self.max_lens[n]) * (len(self.idxs_pos)+1) > self.batch_size:
-          return False
-    elif self.batch_type == 'sentences':
-      if len(self.idxs_pos) == self.batch_size:
-        return False
-    else:
-      logging.error('Bad -batch_type option')
-      sys.exit()
-    return True
+  def encode_lines(self, lines):
+    ### returns the ids (list of ints) of the tokens of each line (list of strings)
+    get, idx_unk = self.tok_to_idx.get, self.idx_unk
+    return [[get(t, idx_unk) for t in l.split()] for l in lines]
 
-  def add(self, pos, lens):
-    self.idxs_pos.append(pos)
-    for n in range(self.n_files):
-      self.max_lens[n] = max(lens[n],self.max_lens[n])
+  def decode(self, ids):
+    ### returns the string of tokens of ids (list, numpy array or torch tensor)
+    if hasattr(ids, 'cpu'): ### torch tensor
+      ids = ids.cpu().numpy()
+    return ' '.join(self.tokens[np.asarray(ids, dtype=np.int64)])
 
-  def __len__(self):
-    return len(self.idxs_pos)
+  def decode_lines(self, ids):
+    ### returns the string of tokens of each row of ids (2-d numpy array or torch tensor, or list of id sequences)
+    if hasattr(ids, 'cpu'): ### torch tensor
+      ids = ids.cpu().numpy()
+    if isinstance(ids, np.ndarray) and ids.ndim == 2:
+      return [' '.join(toks) for toks in self.tokens[ids]]
+    return [self.decode(l) for l in ids]
 
 
 ##############################################################################################################
 ### Dataset ##################################################################################################
 ##############################################################################################################
 class Dataset():
-  def __init__(self, vocs, files, shard_size=500000, batch_size=4096, batch_type='tokens', max_length=100, shuffle = True):
+  def __init__(self, vocs, files, shard_size=500000, batch_size=4096, batch_type='tokens', max_length=100, shuffle = True, stream = False, shuffle_shards = 2, bucket_width = 0, cache_dir = None, n_procs = 1):
     super(Dataset, self).__init__()
     assert len(vocs) == len(files), 'Dataset must be initialized with same number of vocs and files'
     self.shard_size = shard_size
     self.batch_type = batch_type
     self.batch_size = batch_size
     self.max_length = max_length
+    self.bucket_width = bucket_width ### examples are sorted by lengths of all files rounded to bucket_width (0 for source length only)
     self.idx_pad = vocs[0].idx_pad
     self.idx_unk = vocs[0].idx_unk
     self.idx_bos = vocs[0].idx_bos
     self.idx_eos = vocs[0].idx_eos
     self.Idxs = []
     self.shuffle = shuffle
+    self.rank = 0 ### distributed learning: this process only traverses batchs rank, rank+n_ranks, ...
+    self.n_ranks = 1
+    ### iteration state (saved in checkpoints to resume learning in the middle of an epoch)
+    self.epoch = 0 ### epochs started
+    self.epoch_rng = None ### numpy random state when the epoch started (before shuffling examples)
+    self.shard = 0 ### shard being traversed
+    self.shard_rng = None ### numpy random state when the shard batchs were shuffled
+    self.batch = 0 ### batchs already yielded in shard (by this process)
+    self.resume = None ### state to resume from (see load_state_dict)
+    self.window_rng = None ### numpy random state when the shards of the window were read (streaming)
+
+    ### batch plans of shards are saved in cache_dir and loaded instead of rebuilt (same files and batching parameters)
+    self.cache_dir = cache_dir
+    self.cache_key = None
+    if cache_dir is not None:
+      os.makedirs(cache_dir, exist_ok=True)
+      self.cache_key = hashlib.sha1(plan_key(files, [shard_size, batch_size, batch_type, max_length, bucket_width]).encode('utf-8')).hexdigest()[:16]
+
+    self.Lens = [] ### number of tokens of each sentence (numpy array) per file
+    self.Pos = None ### (streaming) position in corpus of each sentence in self.Idxs
+
+    ### streaming: shards are read (shuffle_shards at a time) from disk when traversed, memory depends on shard_size
+    self.stream = stream and shard_size > 0
+    self.shuffle_shards = max(1, shuffle_shards)
+    if self.stream:
+      self.vocs = vocs
+      self.files = files
+      self.Corpora = [] ### MappedCorpus of binarized files (None for text files)
+      self.Offsets = [] ### byte offset where each shard starts in text files
+      for n in range(len(files)):
+        if is_binarized(files[n]):
+          self.Corpora.append(MappedCorpus(files[n]))
+          self.Offsets.append(None)
+          n_lines = len(self.Corpora[-1])
+        else:
+          if not os.path.isfile(files[n]):
+            logging.error('Cannot read file {}'.format(files[n]))
+            sys.exit()
+          offsets, n_lines = shard_offsets(files[n], shard_size)
+          self.Corpora.append(None)
+          self.Offsets.append(offsets)
+        if n == 0:
+          self.n_lines = n_lines
+        assert n_lines == self.n_lines, 'Non-parallel corpus in dataset'
+        logging.info('Indexed Corpus ({} lines ~ {} shards) from {}'.format(n_lines,(n_lines+shard_size-1)//shard_size,files[n]))
+        if self.Corpora[n] is not None: ### token counts saved by minmt-binarize.py, lengths from offsets
+          log_stats(corpus_stats(self.Corpora[n], vocs[n]), files[n], 'Mapped')
+      if None not in self.Corpora: ### lengths of text files are known once their shards are read
+        self.log_projected_padding([corpus.lens for corpus in self.Corpora])
+      return
 
     for n in range(len(files)):
-      if not os.path.isfile(files[n]):
+      if not is_binarized(files[n]) and not os.path.isfile(files[n]):
         logging.error('Cannot read file {}'.format(files[n]))
         sys.exit()
-      with codecs.open(files[n], 'r', 'utf-8') as fd:
-        idxs = [[vocs[n][t] for t in l.split()] for l in fd.read().splitlines()]
+    ### text files are encoded (all at once) by n_procs processes
+    text = [n for n in range(len(files)) if not is_binarized(files[n])]
+    encoded = dict(zip(text, encode_corpora([files[n] for n in text], [vocs[n] for n in text], n_procs)))
+    for n in range(len(files)):
+      idxs = encoded[n] if n in encoded else MappedCorpus(files[n]) ### binarized files are built by minmt-binarize.py
       self.Idxs.append(idxs)
-      ### compute tokens and OOVs
-      n_tok, n_unk = flatten_count(self.Idxs, [self.idx_unk])
-      logging.info('Read Corpus ({} lines ~ {} tokens ~ {} OOVs [{:.2f}%]) from {}'.format(len(idxs),n_tok,n_unk,100.0*n_unk/n_tok,files[n]))
+      self.Lens.append(idxs.lens)
+      ### compute tokens, OOVs and lengths
+      log_stats(corpus_stats(idxs, vocs[n]), files[n], 'Read' if n in encoded else 'Mapped')
       assert len(self.Idxs[0]) == len(self.Idxs[-1]), 'Non-parallel corpus in dataset'
+    self.log_projected_padding(self.Lens)
 
 
-  def build_batchs(self, lens, idxs_pos, n_files):
-    assert len(lens) == len(idxs_pos)
-    ord_lens = np.argsort(lens) #sort by lens (lower to higher lenghts)
-    idxs_pos = np.asarray(idxs_pos)
-    idxs_pos = idxs_pos[ord_lens]
+  def build_batchs(self, idxs_pos, warn=True):
+    ### idxs_pos (numpy array) are positions in self.Idxs, returns a list of batchs (numpy arrays of positions)
+    ### examples sorted by length are added to current batch while it fits (tokens: length of the longest
+    ### sentence times the number of sentences, for all files) examples not fitting in an empty batch are discarded
+    lens = np.stack([self.Lens[n][idxs_pos] for n in range(len(self.Lens))]) + 2 #[n_files, n_examples] (with <bos>, <eos>)
+    ord_lens = self.sort_lens(lens) #lower to higher lengths
+    idxs_pos, lens = idxs_pos[ord_lens], lens[:, ord_lens]
+    if self.batch_type == 'sentences':
+      starts = np.arange(0, len(idxs_pos), self.batch_size)
+      return [idxs_pos[i:i+self.batch_size] for i in starts]
+    if self.batch_type != 'tokens':
+      logging.error('Bad -batch_type option')
+      sys.exit()
 
     batchs = []
-    b = Batch(self.batch_size, self.batch_type, n_files) #empty batch
-    for pos in idxs_pos:
-      lens = self.lens(pos,add=2)
-
-      if not b.fits(lens): ### cannot add in current batch b
-        if len(b):
-          batchs.append(b.idxs_pos) ### save batch
-          b = Batch(self.batch_size, self.batch_type, n_files) #empty batch
-
-      if b.fits(lens):
-        ### add current example
-        b.add(pos,lens)
-      else:
+    i = 0
+    while i < len(idxs_pos):
+      ### batch starting at i has at most batch_size // max(lens[:,i]) examples
+      l = lens[:, i:i + self.batch_size // np.max(lens[:,i]) + 1] #[n_files, w]
+      ntok = np.maximum.accumulate(l, axis=1) * np.arange(1, l.shape[1]+1) #tokens of batch with examples i...i+j
+      fits = (ntok <= self.batch_size).all(axis=0) #[w]
+      n = l.shape[1] if fits.all() else int(np.argmin(fits)) #examples added in batch
+      if n == 0:
         ### discard current example
-        logging.warning('Example {} does not fit in empty batch [Discarded] ~ {}:{}'.format(pos,self.ftxt_src,self.ftxt_tgt))
+        if warn:
+          logging.warning('Example {} does not fit in empty batch [Discarded]'.format(idxs_pos[i]))
+        i += 1
+        continue
+      batchs.append(idxs_pos[i:i+n])
+      i += n
+    return batchs
 
-    if len(b): 
-      ### save last batch
-      batchs.append(b.idxs_pos)
+  def log_projected_padding(self, Lens):
+    ### padding efficiency of build_batchs over all (not too long) examples with lengths Lens, as costly as building all
+    ### batchs: saved with the batch plans when they are cached (computed once for the same files and batching options)
+    fpadding = os.path.join(self.cache_dir, 'padding.{}.npy'.format(self.cache_key)) if self.cache_dir is not None else None
+    if fpadding is not None and os.path.isfile(fpadding):
+      ntoks, nslots = np.load(fpadding)
+    else:
+      Lens, self.Lens = self.Lens, Lens ### build_batchs and keep_length use self.Lens
+      idxs_pos = np.arange(len(self.Lens[0]), dtype=np.int64)
+      ntoks, nslots = padding(self.Lens, self.build_batchs(idxs_pos[self.keep_length(idxs_pos)], warn=False))
+      self.Lens = Lens
+      if fpadding is not None:
+        ftmp = '{}.{}.tmp'.format(fpadding, os.getpid()) ### written then renamed (concurrent processes)
+        with open(ftmp, 'wb') as fd:
+          np.save(fd, np.stack([ntoks, nslots]))
+        os.replace(ftmp, fpadding)
+    logging.info('Projected padding efficiency {} with batch_size {} {}'.format(padding_efficiency(ntoks, nslots), self.batch_size, self.batch_type))
+
+  def sort_lens(self, lens):
+    ### lens [n_files, n_examples] returns the order of examples by (bucketed) lengths of all files (source first)
+    ### similar lengths in all files are batched together, less padding in pre/tgt than when sorting by source only
+    if self.bucket_width <= 0:
+      return np.argsort(lens[0])
+    ### keys: bucket of each file (source is the primary key), exact lengths break ties within buckets
+    return np.lexsort(np.concatenate([lens[::-1], lens[::-1] // self.bucket_width]))
+
+  def log_batchs(self, batchs, how='Built'):
+    ntoks, nslots = padding(self.Lens, batchs)
+    logging.info('{} {} batchs in shard (padding efficiency {})'.format(how, len(batchs), padding_efficiency(ntoks, nslots)))
+
+  def plan_file(self, shard):
+    ### cache file of the batch plan of shard (positions in self.Idxs, and in corpus when streaming)
+    h = hashlib.sha1(shard.tobytes())
+    if self.Pos is not None:
+      h.update(self.Pos[shard].tobytes())
+    return os.path.join(self.cache_dir, 'batchs.{}.{}.npz'.format(self.cache_key, h.hexdigest()))
 
-    logging.info('Built {} batchs in shard'.format(len(batchs)))
+  def load_batchs(self, shard):
+    ### returns the cached batch plan of shard or None
+    if self.cache_dir is None:
+      return None
+    fplan = self.plan_file(shard)
+    if not os.path.isfile(fplan):
+      return None
+    with np.load(fplan) as plan:
+      batchs = np.split(plan['pos'], plan['ends'][:-1]) if len(plan['ends']) else []
+    os.utime(fplan) ### recently used
+    logging.debug('Loaded batchs of shard from {}'.format(fplan))
     return batchs
 
-  def lens(self, pos, add=2):
-    l = []
-    for n in range(len(self.Idxs)):
-      l.append(len(self.Idxs[n][pos]) + add)
-    return l
+  def save_batchs(self, shard, batchs, n_shards):
+    ### shuffled datasets build new shards every epoch: only the plans of the last two epochs are kept (resuming)
+    if self.cache_dir is None or self.rank > 0: ### all processes build the same plans
+      return
+    fplan = self.plan_file(shard)
+    pos = np.concatenate(batchs) if len(batchs) else np.zeros(0, dtype=np.int64)
+    ends = np.cumsum([len(b) for b in batchs], dtype=np.int64)
+    ftmp = '{}.{}.tmp'.format(fplan, os.getpid()) ### written then renamed, concurrent processes never read partial plans
+    with open(ftmp, 'wb') as fd:
+      np.savez(fd, pos=pos, ends=ends)
+    os.replace(ftmp, fplan)
+    logging.debug('Saved batchs of shard in {}'.format(fplan))
+    if self.shuffle:
+      prefix = 'batchs.{}.'.format(self.cache_key)
+      fplans = [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if f.startswith(prefix) and f.endswith('.npz')]
+      fplans.sort(key=lambda f: os.path.getmtime(f), reverse=True)
+      for f in fplans[2*n_shards:]:
+        try:
+          os.remove(f)
+        except FileNotFoundError: ### removed by another process
+          pass
 
-  def filter_length(self, pos):
+  def keep_length(self, idxs_pos):
+    ### returns a boolean mask of the examples (positions) with all files not exceeding max_length tokens
+    keep = np.ones(len(idxs_pos), dtype=bool)
     if self.max_length == 0:
-      return False
-    for n in range(len(self.Idxs)):
-      if len(self.Idxs[n][pos]) > self.max_length:
-        return True
-    return False
+      return keep
+    for n in range(len(self.Lens)):
+      keep &= self.Lens[n][idxs_pos] <= self.max_length
+    return keep
 
-  def __iter__(self):
-    assert len(self.Idxs) > 0, 'Empty dataset'
-    n_files = len(self.Idxs)
+  def state_dict(self):
+    ### iteration state: next batch to yield is the batch-th one of shard (in epoch)
+    return {'epoch': self.epoch, 'epoch_rng': self.epoch_rng, 'shard': self.shard, 'shard_rng': self.shard_rng, 'batch': self.batch, 'window_rng': self.window_rng}
+
+  def load_state_dict(self, state):
+    ### next iteration resumes the epoch in state: same shuffling, consumed shards/batchs are skipped
+    self.epoch = state['epoch'] - 1
+    self.resume = state
+    logging.info('Dataset resumes epoch {} shard {} batch {}'.format(state['epoch'], state['shard']+1, state['batch']))
+
+  def shards(self, resume):
+    ### yields (s, n_shards, shard) each shard is a list of positions in self.Idxs
+    if self.stream:
+      yield from self.stream_shards(resume)
+      return
     n_lines = len(self.Idxs[0])
     ### randomize all data ###
     idxs_pos = [i for i in range(n_lines)]
@@ -177,42 +305,289 @@ class Dataset():
     ### split dataset in shards ###
     self.shard_size = self.shard_size or len(self.Idxs[0])
     shards = [idxs_pos[i:i+self.shard_size] for i in range(0, n_lines, self.shard_size)]
-    ### traverse shards ###
     for s,shard in enumerate(shards): #each shard is a list of positions in the original corpus self.Idxs
+      if resume is not None and s < resume['shard']:
+        continue ### already consumed
+      yield s, len(shards), shard
+
+  def stream_shards(self, resume):
+    ### shards are traversed in random order, shuffle_shards of them (window) are read and their examples shuffled together
+    n_shards = (self.n_lines + self.shard_size - 1) // self.shard_size
+    order = [i for i in range(n_shards)]
+    if self.shuffle:
+      np.random.shuffle(order)
+    for first in range(0, n_shards, self.shuffle_shards):
+      window = order[first:first+self.shuffle_shards]
+      if resume is not None and first + len(window) <= resume['shard']:
+        continue ### already consumed (not read)
+      self.window_rng = get_rng_state()
+      if resume is not None and first <= resume['shard'] and resume.get('window_rng') is not None:
+        set_rng_state(resume['window_rng']) ### same examples shuffling than the interrupted window
+        self.window_rng = resume['window_rng']
+      counts = self.read_window(window)
+      idxs_pos = [i for i in range(len(self.Pos))]
+      if self.shuffle:
+        np.random.shuffle(idxs_pos)
+      ends = np.cumsum(counts) ### each shard keeps its size
+      for j in range(len(window)):
+        if resume is not None and first + j < resume['shard']:
+          continue ### already consumed
+        yield first + j, n_shards, idxs_pos[ends[j]-counts[j]:ends[j]]
+
+  def read_window(self, window):
+    ### reads (and encodes) the examples of shards in window into self.Idxs, returns the number of examples of each shard
+    self.Idxs = [[] for n in range(len(self.files))]
+    pos = []
+    counts = []
+    for shard in window:
+      start = shard * self.shard_size
+      count = min(self.shard_size, self.n_lines - start)
+      for n in range(len(self.files)):
+        self.Idxs[n].extend(self.read_lines(n, shard, count))
+      pos.extend(range(start, start+count))
+      counts.append(count)
+    self.Lens = [np.array([len(l) for l in idxs], dtype=np.int64) for idxs in self.Idxs]
+    self.Pos = np.array(pos, dtype=np.int64)
+    logging.info('Read {} examples from shards {}'.format(len(pos), [shard+1 for shard in window]))
+    return counts
+
+  def read_lines(self, n, shard, count):
+    start = shard * self.shard_size
+    if self.Corpora[n] is not None:
+      return [self.Corpora[n][pos] for pos in range(start, start+count)]
+    with open(self.files[n], 'rb') as fd:
+      fd.seek(self.Offsets[n][shard])
+      return self.vocs[n].encode_lines([fd.readline().decode('utf-8') for _ in range(count)])
+
+  def __iter__(self):
+    assert self.stream or len(self.Idxs) > 0, 'Empty dataset'
+    n_files = len(self.files) if self.stream else len(self.Idxs)
+    resume, self.resume = self.resume, None
+    self.epoch += 1
+    self.epoch_rng = get_rng_state()
+    if resume is not None and resume['epoch_rng'] is not None:
+      set_rng_state(resume['epoch_rng']) ### same shuffling than the interrupted epoch
+      self.epoch_rng = resume['epoch_rng']
+    ### traverse shards ###
+    for s, n_shards, shard in self.shards(resume): #each shard is a list of positions in self.Idxs
+      self.shard, self.batch = s, 0
       ###################
       ### build shard ###
       ###################
-      shard_len = []
-      shard_pos = []
-      for pos in shard:
-        if not self.filter_length(pos):
-          shard_pos.append(pos)
-          shard_len.append(len(self.Idxs[0][pos]))
-          if len(shard_pos) == self.shard_size:
-            break
-      logging.info('Built shard {}/{} ({} examples)'.format(s+1,len(shards),len(shard_pos)))
-      ####################
-      ### build batchs ###
-      ####################
-      batchs = self.build_batchs(shard_len, shard_pos, n_files)
+      shard = np.asarray(shard, dtype=np.int64)
+      batchs = self.load_batchs(shard)
+      if batchs is None:
+        shard_pos = shard[self.keep_length(shard)]
+        logging.info('Built shard {}/{} ({} examples)'.format(s+1,n_shards,len(shard_pos)))
+        ####################
+        ### build batchs ###
+        ####################
+        batchs = self.build_batchs(shard_pos)
+        self.save_batchs(shard, batchs, n_shards)
+        self.log_batchs(batchs)
+      else:
+        self.log_batchs(batchs, 'Loaded')
       ####################
       ### yield batchs ###
       ####################
       idx_batchs = [i for i in range(len(batchs))]
+      self.shard_rng = get_rng_state()
+      if resume is not None and s == resume['shard']:
+        if resume['shard_rng'] is not None:
+          set_rng_state(resume['shard_rng']) ### same batchs order than the interrupted shard
+          self.shard_rng = resume['shard_rng']
+        self.batch = resume['batch']
+        resume = None
       if self.shuffle:
         np.random.shuffle(idx_batchs)
         logging.debug('Shuffled {} batchs'.format(len(idx_batchs)))
-      for i in idx_batchs:
-        batch_pos = batchs[i]
+      if self.n_ranks > 1: ### same (seeded) order in all processes, keep the same number of batchs per process
+        n_batchs = len(idx_batchs) // self.n_ranks * self.n_ranks
+        idx_batchs = idx_batchs[self.rank:n_batchs:self.n_ranks]
+      for i in idx_batchs[self.batch:]:
+        self.batch += 1
+        batch_pos = batchs[i].tolist()
         batch_idx = [] #idxs_all[0] => source batch, idxs_all[1] => target batch, ...
         for n in range(n_files):
           idxs = []
           for pos in batch_pos:
             idxs.append([self.idx_bos] + self.Idxs[n][pos] + [self.idx_eos])
           batch_idx.append(idxs)
+        if self.Pos is not None: ### positions in corpus
+          batch_pos = self.Pos[batchs[i]].tolist()
         yield batch_pos, batch_idx
 
 
 
 
 
+
+
+def plan_key(files, params):
+  ### identifies the batch plans of files (path, size and modification time of each one) built with params
+  stats = []
+  for f in files:
+    fstat = f + '.offsets.npy' if is_binarized(f) else f
+    st = os.stat(fstat)
+    stats.append((os.path.abspath(fstat), st.st_size, st.st_mtime_ns))
+  return repr((stats, params))
+
+def shard_offsets(ftxt, shard_size):
+  ### returns the byte offset of the first line of each shard of ftxt and the number of lines (ending with b'\n', see split_lines)
+  offsets = []
+  n_lines, offset = 0, 0
+  with open(ftxt, 'rb') as fd:
+    for l in fd:
+      if n_lines % shard_size == 0:
+        offsets.append(offset)
+      offset += len(l)
+      n_lines += 1
+  return offsets, n_lines
+
+
+##############################################################################################################
+### MappedCorpus #############################################################################################
+##############################################################################################################
+### binarized corpus PREFIX (built by minmt-binarize.py) consists of numpy files:
+###   PREFIX.ids.npy     : token ids of all sentences (flat int16 or int32 array)
+###   PREFIX.offsets.npy : start of each sentence in ids (int64 array of #lines+1 entries)
+###   PREFIX.counts.npy  : frequency of each token id (int64 array of vocabulary size entries, statistics)
+### both are memory-mapped (read-only): pages are loaded on demand and shared by all processes
+
+def is_binarized(prefix):
+  return not os.path.isfile(prefix) and os.path.isfile(prefix + '.ids.npy') and os.path.isfile(prefix + '.offsets.npy')
+
+def ids_dtype(voc):
+  return np.int16 if len(voc) <= np.iinfo(np.int16).max+1 else np.int32
+
+class EncodedCorpus():
+  ### token ids of all sentences (flat array) and start of each sentence (#lines+1 offsets)
+  def __init__(self, ids, offsets):
+    self.ids = ids
+    self.offsets = offsets
+    self.lens = np.diff(self.offsets) #[n_lines]
+    self.counts = None ### frequency of each token id (computed once)
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, pos):
+    ### token ids of sentence pos (list of ints)
+    return self.ids[self.offsets[pos]:self.offsets[pos+1]].tolist()
+
+  def n_tokens(self):
+    return int(self.offsets[-1])
+
+  def token_counts(self, voc_size):
+    if self.counts is None:
+      self.counts = token_counts(self.ids, voc_size)
+    return self.counts
+
+class MappedCorpus(EncodedCorpus):
+  def __init__(self, prefix):
+    super(MappedCorpus, self).__init__(np.load(prefix + '.ids.npy', mmap_mode='r'), np.load(prefix + '.offsets.npy', mmap_mode='r'))
+    if os.path.isfile(prefix + '.counts.npy'): ### saved by binarize (avoids reading all ids)
+      self.counts = np.load(prefix + '.counts.npy')
+
+def binarize(ftxt, voc, prefix, chunk_size=100000):
+  ### writes prefix.ids.npy and prefix.offsets.npy with the token ids (voc) of ftxt, returns (#lines, #tokens, #unks)
+  dtype = ids_dtype(voc)
+  chunks = [] ### token ids of chunk_size lines
+  lens = []
+  with open(ftxt, 'rb') as fd: ### binary lines end with b'\n' only (see split_lines)
+    while True:
+      idxs = voc.encode_lines([l.decode('utf-8') for l in itertools.islice(fd, chunk_size)])
+      if len(idxs) == 0:
+        break
+      lens.extend([len(l) for l in idxs])
+      chunks.append(np.fromiter(itertools.chain.from_iterable(idxs), dtype=dtype, count=sum(lens[-len(idxs):])))
+  counts = write_binarized(prefix, chunks, lens, len(voc), dtype)
+  return len(lens), int(np.sum(lens)), int(counts[voc.idx_unk])
+
+def write_binarized(prefix, chunks, lens, voc_size, dtype):
+  ### writes the binarized corpus prefix with token ids given in chunks (arrays) of lines with lens, returns the token counts
+  offsets = np.zeros(len(lens)+1, dtype=np.int64)
+  np.cumsum(lens, out=offsets[1:])
+  out = np.lib.format.open_memmap(prefix + '.ids.npy', mode='w+', dtype=dtype, shape=(int(offsets[-1]),))
+  counts = np.zeros(voc_size, dtype=np.int64)
+  start = 0
+  for chunk in chunks:
+    out[start:start+len(chunk)] = chunk
+    counts += token_counts(chunk, voc_size)
+    start += len(chunk)
+  out.flush()
+  del out
+  np.save(prefix + '.offsets.npy', offsets)
+  np.save(prefix + '.counts.npy', counts)
+  return counts
+
+
+def chunk_offsets(ftxt, chunk_size):
+  ### returns byte offsets [0, ..., size] splitting ftxt in chunks of about chunk_size bytes starting at the beginning of a line
+  size = os.path.getsize(ftxt)
+  offsets = [0]
+  with open(ftxt, 'rb') as fd:
+    for start in range(chunk_size, size, chunk_size):
+      if start <= offsets[-1]:
+        continue ### inside the (long) last line
+      fd.seek(start-1)
+      fd.readline() ### next line starts after the newline found
+      offsets.append(fd.tell())
+  if offsets[-1] < size:
+    offsets.append(size)
+  return offsets
+
+def split_lines(text):
+  ### lines of text separated by '\n' only, the rule of every reader (offsets of shards and chunks, streaming, encoding)
+  ### str.splitlines() would also split on '\r', '\x1c', '\x85', '\u2028'... and break the alignment of parallel files
+  lines = text.split('\n')
+  if lines[-1] == '':
+    lines.pop() ### after the last newline
+  return lines
+
+encode_vocs = None ### vocabularies of encode_chunk (set once in each process of the pool)
+
+def set_encode_vocs(vocs):
+  global encode_vocs
+  encode_vocs = vocs
+
+def encode_chunk(n, ftxt, start, end):
+  ### returns the token ids (flat array) and lengths of the lines of ftxt in bytes [start, end) using vocab n
+  with open(ftxt, 'rb') as fd:
+    fd.seek(start)
+    lines = split_lines(fd.read(end-start).decode('utf-8'))
+  idxs = encode_vocs[n].encode_lines(lines)
+  lens = np.array([len(l) for l in idxs], dtype=np.int64)
+  ids = np.fromiter(itertools.chain.from_iterable(idxs), dtype=ids_dtype(encode_vocs[n]), count=int(lens.sum()))
+  return ids, lens
+
+def encode_corpora(files, vocs, n_procs=1, chunk_size=2**22):
+  ### returns an EncodedCorpus for each text file, line-aligned chunks of all files are encoded by a pool of n_procs processes
+  tasks = []
+  for n in range(len(files)):
+    offsets = chunk_offsets(files[n], chunk_size)
+    tasks.extend([(n, files[n], start, end) for start, end in zip(offsets[:-1], offsets[1:])])
+  if n_procs > 1 and len(tasks) > 1:
+    with multiprocessing.get_context('fork').Pool(min(n_procs, len(tasks)), initializer=set_encode_vocs, initargs=(vocs,)) as pool:
+      results = pool.starmap(encode_chunk, tasks)
+  else:
+    set_encode_vocs(vocs)
+    results = [encode_chunk(*task) for task in tasks]
+  corpora = []
+  for n in range(len(files)):
+    chunks = [results[i] for i in range(len(tasks)) if tasks[i][0] == n]
+    ids = np.concatenate([c[0] for c in chunks]) if len(chunks) else np.zeros(0, dtype=ids_dtype(vocs[n]))
+    offsets = np.zeros(sum([len(c[1]) for c in chunks])+1, dtype=np.int64)
+    if len(chunks):
+      np.cumsum(np.concatenate([c[1] for c in chunks]), out=offsets[1:])
+    corpora.append(EncodedCorpus(ids, offsets))
+  return corpora
+
+def get_rng_state():
+  ### numpy random state as a (picklable) list of python types
+  name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+  return [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+
+def set_rng_state(state):
+  name, keys, pos, has_gauss, cached_gaussian = state
+  np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
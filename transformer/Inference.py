@@ -7,7 +7,7 @@ import numpy as np
 from collections import defaultdict
 import torch
 import math
-from transformer.Model import prepare_source, prepare_prefix
+from transformer.Model import prepare_source, prepare_prefix, causal_mask, Mask, Profiler
 
 def norm_length(l, alpha):
   if alpha == 0.0:
@@ -35,6 +35,8 @@ class Inference():
     self.mask_prefix = oi.mask_prefix
     self.device = device
     self.next_wrds = torch.tensor([i for i in range(self.Vt)], dtype=int, device=self.device).view(1,-1) #[1,Vt]
+    self.msk_tgt = {} #lt => Mask of causal mask [1,lt,lt] (built once per decoding session)
+    self.profiler = Profiler(oi.profile_steps, oi.dnet, 'translate') #steps are batchs
 
 
   def translate(self, testset, output):
@@ -47,14 +49,20 @@ class Inference():
 
     with torch.no_grad():
       self.model.eval()
-      for pos, [batch_src, batch_pre] in testset:
+      n_batch = 0
+      self.profiler.step(n_batch)
+      for pos, [batch_src, batch_pre] in self.profiler.iterate(testset, 'data'):
         self.batch_pre = None
 
-        src, self.msk_src = prepare_source(batch_src, self.src_voc.idx_pad, self.device) #src is [bs, ls] msk_src is [bs,1,ls]
-        pre, self.msk_pre = prepare_source(batch_pre, self.tgt_voc.idx_pad, self.device)
+        with self.profiler.region('prepare_source'):
+          src, msk_src = prepare_source(batch_src, self.src_voc.idx_pad, self.device) #src is [bs, ls] msk_src is [bs,1,ls]
+          pre, msk_pre = prepare_source(batch_pre, self.tgt_voc.idx_pad, self.device)
+          self.msk_src, self.msk_pre = Mask(msk_src), Mask(msk_pre) #built once per batch (expanded to bs*K once)
         ### encode
-        self.z_src = self.model.encode_src(src, self.msk_src)
-        self.z_pre = self.model.encode_pre(pre, self.msk_pre)
+        with self.profiler.region('encode_src'):
+          self.z_src = self.model.encode_src(src, self.msk_src)
+        with self.profiler.region('encode_pre'):
+          self.z_pre = self.model.encode_pre(pre, self.msk_pre)
 
         ### decode step-by-step
         finals = self.traverse_beam()
@@ -66,6 +74,9 @@ class Inference():
             fh.flush()
             if n+1 >= self.N:
               break
+        n_batch += 1
+        self.profiler.step(n_batch)
+      self.profiler.step(self.profiler.last) ### testset ended before last step
 
     if output != '-':
       fh.close()
@@ -82,17 +93,17 @@ class Inference():
       #hyps is [I,lt] ; K is 1*K OR bs*K ; lt is the hyp length [1, 2, ..., max_size)
       I, lt = hyps.shape 
 
-      if lt == 2:
-        self.z_src = self.z_src.repeat_interleave(repeats=self.K, dim=0) #[bs,ls,ed] => [bs*K,ls,ed]
-        self.msk_src = self.msk_src.repeat_interleave(repeats=self.K, dim=0) #[bs,1,ls] => [bs*K,1,ls]
-
       ##############
       ### DECODE ###
       ##############
-      msk_tgt = (1 - torch.triu(torch.ones((1, lt, lt), device=self.device), diagonal=1)).bool()
-      y_next = self.model.decode(hyps, msk_tgt, self.z_src, self.msk_src, self.z_pre, self.msk_pre)[:,-1,:] #[I,lt,Vt] => [I,Vt]
-
-      hyps, logP = self.expand(y_next, hyps, logP, bs) #both are [bs,1*Vt,lt] OR [bs,K*Vt,lt]
+      ### z_src/z_pre (and masks) are not repeated for the K hypotheses of each sentence, attention layers expand them
+      if lt not in self.msk_tgt:
+        self.msk_tgt[lt] = Mask(causal_mask(lt, self.device))
+      with self.profiler.region('decode'):
+        y_next = self.model.decode(hyps, self.msk_tgt[lt], self.z_src, self.msk_src, self.z_pre, self.msk_pre)[:,-1,:] #[I,lt,Vt] => [I,Vt]
+
+      with self.profiler.region('expand'):
+        hyps, logP = self.expand(y_next, hyps, logP, bs) #both are [bs,1*Vt,lt] OR [bs,K*Vt,lt]
       
       if lt == self.max_size - 1: #last extension (force <eos> to appear in all hypotheses)
         logP = self.force_eos(logP) #both are [bs,1*Vt,lt] OR [[bs,K*Vt,lt]
@@ -100,7 +111,8 @@ class Inference():
       elif self.batch_pre is not None and lt < lp: #force decoding using prefix
         logP = self.force_prefix(hyps, logP, self.batch_pre[:,lt], self.mask_prefix) #both are [bs,1*Vt,lt] OR [[bs,K*Vt,lt]
 
-      hyps, logP = self.Kbest(hyps, logP) #both are [bs*K,lt]
+      with self.profiler.region('Kbest'):
+        hyps, logP = self.Kbest(hyps, logP) #both are [bs*K,lt]
 
       ##############
       ### FINALS ###
@@ -203,7 +215,7 @@ class Inference():
     logP_bs_k = logP.view(bs,self.K,lt)
     for b in range(hyps_bs_k.shape[0]):
       for k in range(hyps_bs_k.shape[1]):
-        logging.info('batch {} beam {}\tlogP={:.6f}\t{}'.format(b, k, sum(logP_bs_k[b,k]), ' '.join([self.tgt_voc[t] for t in hyps_bs_k[b,k].tolist()]) ))
+        logging.info('batch {} beam {}\tlogP={:.6f}\t{}'.format(b, k, sum(logP_bs_k[b,k]), self.tgt_voc.decode(hyps_bs_k[b,k]) ))
 
 
   def format_hyp(self, p, n, c, tgt_idx, src_idx): 
@@ -227,14 +239,14 @@ class Inference():
       ### input sentence ###
       ######################
       elif ch=='s':
-        out.append(' '.join([self.src_voc[idx] for idx in src_idx[1:-1]])) ### input sentence (tokenized)
+        out.append(self.src_voc.decode(src_idx[1:-1])) ### input sentence (tokenized)
       elif ch=='j':
         out.append(' '.join(map(str,src_idx))) ### input sentence (idxs)
       #########################
       ### target hypothesis ###
       #########################
       elif ch=='t':
-        out.append(' '.join([self.tgt_voc[idx] for idx in tgt_idx[1:-1]])) ### output sentence (tokenized)
+        out.append(self.tgt_voc.decode(tgt_idx[1:-1])) ### output sentence (tokenized)
       elif ch=='i':
         out.append(' '.join(map(str,tgt_idx))) ### output sentence (idxs)
 
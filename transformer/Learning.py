@@ -4,8 +4,10 @@ import logging
 import numpy as np
 import torch
 import time
+import contextlib
+import queue
 
-from transformer.Model import save_checkpoint, prepare_source, prepare_target
+from transformer.Model import CheckpointSaver, Profiler, snapshot, prepare_source, prepare_target
 
 try:
   from torch.utils.tensorboard import SummaryWriter
@@ -30,6 +32,20 @@ def pad_prefix(ref, idx_sep, idx_pad): ### not used anymore
   #logging.info('ref = {}'.format(ref))
   return ref
 
+def eval_msk(pred, gold, idx_msk):
+  ### number of masked tokens in gold and of those predicted as masked
+  bs, lt, ed = pred.shape
+  gold = gold.contiguous().view([bs*lt])
+  pred = pred.contiguous().view([bs*lt,-1])
+  inds_gold_msk = (gold==idx_msk).nonzero(as_tuple=True)[0] #[n] indexs i of gold where gold[i]=idx_msk
+  n_ok_msk = 0
+  n_msk = torch.numel(inds_gold_msk)
+  if n_msk > 0:
+    _, inds_pred = torch.topk(pred, k=1, dim=1)
+    inds_pred_msk = inds_pred[inds_gold_msk].squeeze()
+    n_ok_msk = torch.sum(inds_pred_msk==idx_msk).item() #.nonzero(as_tuple=False)
+  return n_msk, n_ok_msk
+
 ##############################################################################################################
 ### Score ####################################################################################################
 ##############################################################################################################
@@ -41,18 +57,45 @@ class Score():
     self.nsteps_report = 0
     self.n_msk = 0
     self.n_ok_msk = 0
+    self.ntoks = {'src': 0, 'pre': 0, 'tgt': 0} ### real tokens per stream
+    self.nslots = {'src': 0, 'pre': 0, 'tgt': 0} ### tokens once padded per stream
+    self.secs = {'data': 0., 'forward': 0., 'backward': 0., 'optimizer': 0.}
     self.start_report = time.time()
+    self.end_report = None
 
-  def step(self, sum_loss_batch, ntok_batch, pred, gold, idx_msk):
+  def step(self, sum_loss_batch, ntok_batch, n_msk, n_ok_msk):
+    ### accumulates one (micro-)batch (n_msk, n_ok_msk from eval_msk), use update() once the optimizer step is done
     self.sum_loss_report += sum_loss_batch
     self.sum_toks_report += ntok_batch
-    self.nsteps_report += 1
-    n_msk, n_ok_msk = self.eval_msk(pred, gold, idx_msk)
     self.n_msk += n_msk
     self.n_ok_msk += n_ok_msk
 
+  def update(self):
+    self.nsteps_report += 1
+
+  def tokens(self, stream, batch):
+    ### batch is a list of (unpadded) sentences of stream (src, pre or tgt)
+    lens = [len(l) for l in batch]
+    self.ntoks[stream] += sum(lens)
+    self.nslots[stream] += len(lens) * max(lens)
+
+  def time(self, part, secs):
+    self.secs[part] += secs
+
+  def efficiency(self):
+    ### tokens/sec and padding ratio (%) per stream, time split (%) of the report period
+    secs_report = (self.end_report or time.time()) - self.start_report
+    eff = {}
+    for stream in self.ntoks:
+      eff['tok_per_sec/' + stream] = self.ntoks[stream] / secs_report
+      eff['padding/' + stream] = 100.0 * (1.0 - self.ntoks[stream] / self.nslots[stream]) if self.nslots[stream] else 0.
+    for part in self.secs:
+      eff['time/' + part] = 100.0 * self.secs[part] / secs_report
+    return eff
+
   def report(self):
     end_report= time.time()
+    self.end_report = end_report
     if self.sum_toks_report and self.nsteps_report:
       loss_per_tok = self.sum_loss_report / (1.0*self.sum_toks_report)
       steps_per_sec = self.nsteps_report / (end_report - self.start_report)
@@ -62,19 +105,6 @@ class Score():
     logging.warning('Requested report after 0 tokens optimised')
     return 0., 0
 
-  def eval_msk(self, pred, gold, idx_msk):
-    bs, lt, ed = pred.shape
-    gold = gold.contiguous().view([bs*lt])
-    pred = pred.contiguous().view([bs*lt,-1])
-    inds_gold_msk = (gold==idx_msk).nonzero(as_tuple=True)[0] #[n] indexs i of gold where gold[i]=idx_msk
-    n_ok_msk = 0
-    n_msk = torch.numel(inds_gold_msk)
-    if n_msk > 0:
-      _, inds_pred = torch.topk(pred, k=1, dim=1)
-      inds_pred_msk = inds_pred[inds_gold_msk].squeeze()
-      n_ok_msk = torch.sum(inds_pred_msk==idx_msk) #.nonzero(as_tuple=False)
-    return n_msk, n_ok_msk
-
 ##############################################################################################################
 ### Learning #################################################################################################
 ##############################################################################################################
@@ -89,119 +119,425 @@ class Learning():
     self.max_steps = ol.max_steps
     self.max_epochs = ol.max_epochs
     self.validate_every = ol.validate_every
+    self.validate_async = ol.validate_async
+    self.valid_batchs = None ### validation batchs (tensors) built once
+    self.validator = None ### background validation process
     self.save_every = ol.save_every
     self.report_every = ol.report_every
     self.keep_last_n = ol.keep_last_n
+    self.checkpointer = CheckpointSaver(suffix, ol.keep_last_n, ol.max_async_saves)
     self.clip = ol.clip
+    self.accum_steps = ol.accum_steps
+    self.accum_tokens = ol.accum_tokens
+    self.n_oom = 0 ### batchs split after running out of memory
+    self.backward_started = False
+    self.stashed_grads = None ### gradients accumulated before the running backward (see stash_grads)
     self.mask_prefix = ol.mask_prefix
     self.idx_pad = idx_pad
     self.idx_sep = idx_sep
     self.idx_msk = idx_msk
+    ### distributed learning (one process per rank): only rank 0 validates, saves and logs to tensorboard
+    self.distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    self.rank = torch.distributed.get_rank() if self.distributed else 0
+    self.n_ranks = torch.distributed.get_world_size() if self.distributed else 1
+    self.profiler = Profiler(ol.profile_steps, ol.dnet, 'train' if self.rank == 0 else 'train_rank{}'.format(self.rank))
+    self.model_train = torch.nn.parallel.DistributedDataParallel(model, broadcast_buffers=False) if self.distributed else model ### constant buffers (no collective in forward: processes may run different numbers of micro-batches)
 
-    if tensorboard:
+    if tensorboard and self.rank == 0:
       self.writer = SummaryWriter(log_dir=ol.dnet, comment='', purge_step=None, max_queue=10, flush_secs=60, filename_suffix='')
 
   def learn(self, trainset, validset, device):
     logging.info('Running: learning')
-    n_epoch = 0
+    n_epoch = trainset.epoch ### epochs already done (when resuming from a checkpoint)
+    n_accum = 0 ### micro-batches accumulated since last update
+    ntok_accum = 0 ### non-pad target tokens accumulated since last update (all ranks)
+    self.profiler.step(self.optScheduler._step)
+    reset_peak_memory(device) ### peak memory of each report window
     while True: #repeat epochs
       n_epoch += 1
       logging.info('Epoch {}'.format(n_epoch))
       n_batch = 0
       score = Score()
       #for batch_pos, [batch_src, batch_tgt] in trainset:
-      for batch_pos, [batch_src, batch_tgt, batch_pre] in trainset:
+      tic_data = time.time()
+      for batch_pos, [batch_src, batch_tgt, batch_pre] in self.profiler.iterate(trainset, 'data'):
         n_batch += 1
-        self.model.train()
+        self.model_train.train()
         ###
         ### forward
         ###
-        src, msk_src = prepare_source(batch_src, self.idx_pad, device)
-        pre, msk_pre = prepare_source(batch_pre, self.idx_pad, device)
+        with self.profiler.region('prepare_source'):
+          src, msk_src = prepare_source(batch_src, self.idx_pad, device)
+          pre, msk_pre = prepare_source(batch_pre, self.idx_pad, device)
+        with self.profiler.region('prepare_target'):
+          tgt, ref, msk_tgt = prepare_target(batch_tgt, self.idx_pad, self.idx_sep, self.idx_msk, self.mask_prefix, device)
+        for stream, batch in [('src', batch_src), ('pre', batch_pre), ('tgt', batch_tgt)]:
+          score.tokens(stream, batch)
+        score.time('data', time.time() - tic_data) ### reading and preparing batch
+        ntok_batch = torch.sum(ref != self.idx_pad).item()
+        n_accum += 1
+        ntok_accum += self.sum_ranks(ntok_batch) ### all processes must agree on when to update
+        do_update = self.accum_done(n_accum, ntok_accum)
+        if n_accum == 1:
+          self.optScheduler.optimizer.zero_grad() ### sets gradients to zero
 
-        tgt, ref, msk_tgt = prepare_target(batch_tgt, self.idx_pad, self.idx_sep, self.idx_msk, self.mask_prefix, device)
-
-        pred = self.model.forward(src, pre, tgt, msk_src, msk_pre, msk_tgt) #no log_softmax is applied
-        ###
-        ### compute loss
         ###
-        loss_batch = self.criter(pred, ref) #sum of losses in batch
-        loss_token = loss_batch / torch.sum(ref != self.idx_pad) #ntok_batch
-        ### optimize
+        ### forward, compute loss and accumulate gradients (normalised by the number of tokens once all micro-batches are seen)
         ###
-        self.optScheduler.optimizer.zero_grad() ### sets gradients to zero
-        loss_token.backward() ### computes gradients
-        if self.clip > 0.0: ### clip gradients norm
-          torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
-        self.optScheduler.step() ### updates model parameters after incrementing step and updating lr
+        for _, loss_part, ntok_part, n_msk, n_ok_msk, secs_forward, secs_backward in self.forward_backward([src, pre, tgt, msk_src, msk_pre, msk_tgt, ref], do_update, n_accum == 1):
+          score.step(loss_part, ntok_part, n_msk, n_ok_msk)
+          score.time('forward', secs_forward)
+          score.time('backward', secs_backward)
+        if not do_update:
+          tic_data = time.time()
+          continue
         ###
-        ### accumulate score
+        ### optimize
         ###
-        score.step(loss_batch.item(), torch.sum(ref!=self.idx_pad), pred, ref, self.idx_msk)
+        tic = time.time()
+        with self.profiler.region('optimizer'):
+          self.normalise_gradients(ntok_accum / self.n_ranks) ### DistributedDataParallel averages gradients over ranks
+          if self.clip > 0.0: ### clip gradients norm
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.clip)
+          self.optScheduler.step() ### updates model parameters after incrementing step and updating lr
+        synchronize(device)
+        score.time('optimizer', time.time() - tic)
+        self.profiler.step(self.optScheduler._step)
+        n_accum, ntok_accum = 0, 0
+        score.update()
+        self.poll_validation()
         ###
         ### report
         ###
-        if self.report_every and self.optScheduler._step % self.report_every == 0:
+        if self.report_every and self.optScheduler._step % self.report_every == 0 and self.rank == 0:
           loss_per_tok, steps_per_sec = score.report()
           logging.info('Learning step: {} epoch: {} batch: {} steps/sec: {:.2f} lr: {:.6f} Loss: {:.3f}'.format(self.optScheduler._step, n_epoch, n_batch, steps_per_sec, self.optScheduler._rate, loss_per_tok))
+          eff = score.efficiency()
+          peak = peak_memory(device)
+          reset_peak_memory(device)
+          if peak is not None:
+            eff['peak_memory_mb'] = peak
+          self.report_efficiency(eff)
           score = Score()
+          self.report_recompute(steps_per_sec)
           if tensorboard:
-            self.writer.add_scalar('Loss/train', loss_token.item(), self.optScheduler._step)
+            self.writer.add_scalar('Loss/train', loss_per_tok, self.optScheduler._step)
             self.writer.add_scalar('LearningRate', self.optScheduler._rate, self.optScheduler._step)
+            self.writer.add_scalar('OOM/batchs_split', self.n_oom, self.optScheduler._step)
+            for k, v in eff.items():
+              self.writer.add_scalar('Efficiency/' + k, v, self.optScheduler._step)
         ###
         ### validate
         ###
-        if self.validate_every and self.optScheduler._step % self.validate_every == 0:
+        if self.validate_every and self.optScheduler._step % self.validate_every == 0 and self.rank == 0:
           if validset is not None:
             vloss = self.validate(validset, device)
         ###
         ### save
         ###
-        if self.save_every and self.optScheduler._step % self.save_every == 0:
-          save_checkpoint(self.suffix, self.model, self.optScheduler.optimizer, self.optScheduler._step, self.keep_last_n)
+        if self.save_every and self.optScheduler._step % self.save_every == 0 and self.rank == 0:
+          self.checkpointer.save(self.model, self.optScheduler.optimizer, self.optScheduler._step, trainset.state_dict())
+        tic_data = time.time()
         ###
         ### stop by max_steps
         ###
         if self.max_steps and self.optScheduler._step >= self.max_steps:
-          if validset is not None:
+          if validset is not None and self.rank == 0:
             vloss = self.validate(validset, device)
-          save_checkpoint(self.suffix, self.model, self.optScheduler.optimizer, self.optScheduler._step, self.keep_last_n)
+          if self.rank == 0:
+            self.checkpointer.save(self.model, self.optScheduler.optimizer, self.optScheduler._step, trainset.state_dict())
+            self.checkpointer.wait()
+          self.stop_validation()
+          self.profiler.step(self.profiler.last) ### learning ended before last profiled step
           logging.info('Learning STOP by [steps={}]'.format(self.optScheduler._step))
           return
       ###
       ### stop by max_epochs
       ###
       if self.max_epochs and n_epoch >= self.max_epochs: ### stop by max_epochs
-        if validset is not None:
+        if validset is not None and self.rank == 0:
           vloss = self.validate(validset, device)
-        save_checkpoint(self.suffix, self.model, self.optScheduler.optimizer, self.optScheduler._step, self.keep_last_n)
+        if self.rank == 0:
+          self.checkpointer.save(self.model, self.optScheduler.optimizer, self.optScheduler._step, trainset.state_dict())
+          self.checkpointer.wait()
+        self.stop_validation()
+        self.profiler.step(self.profiler.last) ### learning ended before last profiled step
         logging.info('Learning STOP by [epochs={}]'.format(n_epoch))
         return
 
+  def report_efficiency(self, eff):
+    logging.info('Efficiency tok/sec {} padding {} time {} peak_memory: {}'.format(
+      ' '.join(['{}: {:.1f}'.format(k.split('/')[1], v) for k, v in eff.items() if k.startswith('tok_per_sec/')]),
+      ' '.join(['{}: {:.1f}%'.format(k.split('/')[1], v) for k, v in eff.items() if k.startswith('padding/')]),
+      ' '.join(['{}: {:.1f}%'.format(k.split('/')[1], v) for k, v in eff.items() if k.startswith('time/')]),
+      '{:.1f}MB'.format(eff['peak_memory_mb']) if 'peak_memory_mb' in eff else 'n/a'))
+
+  def report_recompute(self, steps_per_sec):
+    ### activation checkpointing: memory not kept during forward vs. time spent recomputing it
+    stacks = [('src', self.model.stacked_encoder_src), ('pre', self.model.stacked_encoder_pre), ('tgt', self.model.stacked_decoder)]
+    out = []
+    for name, stack in stacks:
+      if stack.recompute is not None:
+        nbytes, secs = stack.recompute.reset()
+        out.append('{}: {:.1f}MB/{:.3f}sec'.format(name, nbytes / self.report_every / 2**20, secs / self.report_every))
+    if len(out):
+      logging.info('Recomputed activations per step {} (step: {:.3f}sec)'.format(' '.join(out), 1.0/steps_per_sec if steps_per_sec else 0.))
+
+  def forward_backward(self, batch, do_update, first):
+    ### batch is [src, pre, tgt, msk_src, msk_pre, msk_tgt, ref] returns [(rows, loss, ntok, n_msk, n_ok_msk, secs_forward, secs_backward), ...] one per micro-batch
+    ### when out of memory the rows not yet done are run again split in 2, 4, ... micro-batches accumulating gradients (same update)
+    ### micro-batches done are kept, gradients accumulated before a failed backward are restored (see forward_backward_split)
+    bs = batch[0].shape[0]
+    out = []
+    n_split = 1
+    while True:
+      done = sum([part[0] for part in out]) ### rows whose gradients are accumulated
+      rest = [t[done:] for t in batch]
+      try:
+        self.forward_backward_split(rest, do_update, n_split, out, first)
+        return out
+      except RuntimeError as e:
+        if not is_oom(e) or n_split == bs - done:
+          raise
+        phase = 'backward' if self.backward_started else 'forward'
+        if self.backward_started and self.stashed_grads is None and not (first and len(out) == 0):
+          logging.error('Out of memory in backward of an all-reduced micro-batch (gradients partially updated, cannot be split)')
+          raise
+        logging.debug(str(e))
+      ### graph of the failed pass is freed once out of the except clause
+      if self.backward_started:
+        self.restore_grads() ### drops the partial gradients of the failed micro-batch
+      if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+      if n_split == 1 and len(out) == 0:
+        self.n_oom += 1
+      n_split = min(2*n_split, bs - done)
+      logging.warning('Out of memory in {} with batch {}, retrying {} rows not done as {} micro-batches ({} batchs split so far, step: {})'.format(phase, 'x'.join(map(str, batch[2].shape)), bs - done, n_split, self.n_oom, self.optScheduler._step))
+
+  def forward_backward_split(self, batch, do_update, n_split, out, first):
+    ### appends to out each micro-batch once its gradients are accumulated (logits are dropped once scored)
+    ### gradients accumulated before are set aside during backward (not copied) and added once it succeeds, except in
+    ### the micro-batch all-reduced by DistributedDataParallel (it reduces the gradients found in parameters)
+    for i, (src, pre, tgt, msk_src, msk_pre, msk_tgt, ref) in enumerate(zip(*[torch.tensor_split(t, n_split) for t in batch])):
+      self.backward_started = False
+      do_sync = do_update and i == n_split-1
+      with self.sync_gradients(do_sync):
+        tic = time.time()
+        pred = self.model_train.forward(src, pre, tgt, msk_src, msk_pre, msk_tgt) #no log_softmax is applied
+        with self.profiler.region('loss'):
+          loss_batch = self.criter(pred, ref) #sum of losses in batch
+        n_msk, n_ok_msk = eval_msk(pred.detach(), ref, self.idx_msk)
+        del pred
+        synchronize(src.device)
+        secs_forward = time.time() - tic
+        self.stash_grads(not (first and len(out) == 0) and not (self.distributed and do_sync))
+        self.backward_started = True
+        tic = time.time()
+        with self.profiler.region('backward'):
+          loss_batch.backward() ### computes (unnormalised) gradients
+        synchronize(src.device)
+        secs_backward = time.time() - tic
+        self.unstash_grads()
+      out.append((ref.shape[0], loss_batch.item(), torch.sum(ref != self.idx_pad).item(), n_msk, n_ok_msk, secs_forward, secs_backward))
+
+  def stash_grads(self, accumulated):
+    ### gradients accumulated so far are set aside: backward starts from empty gradients
+    self.stashed_grads = None
+    if accumulated:
+      self.stashed_grads = [p.grad for p in self.model.parameters()]
+      for p in self.model.parameters():
+        p.grad = None
+
+  def unstash_grads(self):
+    ### adds the gradients set aside to the ones of the last backward
+    if self.stashed_grads is None:
+      return
+    for p, g in zip(self.model.parameters(), self.stashed_grads):
+      if g is not None:
+        if p.grad is not None:
+          g.add_(p.grad)
+        p.grad = g
+    self.stashed_grads = None
+
+  def restore_grads(self):
+    ### gradients are back as before the failed backward (zero when nothing was accumulated)
+    if self.stashed_grads is None:
+      self.optScheduler.optimizer.zero_grad()
+      return
+    for p, g in zip(self.model.parameters(), self.stashed_grads):
+      p.grad = g
+    self.stashed_grads = None
+
+  def accum_done(self, n_accum, ntok_accum):
+    ### True when enough micro-batches (or tokens) are accumulated to perform one optimizer step
+    if self.accum_tokens > 0:
+      return ntok_accum >= self.accum_tokens
+    return n_accum >= self.accum_steps
+
+  def sum_ranks(self, n):
+    ### sum of n over all processes (n itself when not distributed)
+    if not self.distributed:
+      return n
+    t = torch.tensor([n], dtype=torch.float64)
+    torch.distributed.all_reduce(t)
+    return int(t.item())
+
+  def sync_gradients(self, do_sync):
+    ### gradients are all-reduced over processes only in the last accumulated micro-batch
+    if self.distributed and not do_sync:
+      return self.model_train.no_sync()
+    return contextlib.nullcontext()
+
+  def normalise_gradients(self, ntok):
+    ### gradients are accumulated from summed losses: divide by the overall number of tokens
+    if ntok == 0:
+      return
+    for p in self.model.parameters():
+      if p.grad is not None:
+        p.grad.div_(ntok)
+
   def validate(self, validset, device):
+    if self.valid_batchs is None:
+      self.valid_batchs = self.prepare_batchs(validset, device)
+    if self.validate_async:
+      self.validate_background()
+      return None
     tic = time.time()
-    valid_loss = 0.
-    n_batch = 0
-    with torch.no_grad():
-      self.model.eval()
-      for batch_pos, [batch_src, batch_tgt,batch_pre] in validset:
-        n_batch += 1
-        src, msk_src = prepare_source(batch_src, self.idx_pad, device)
-        pre, msk_pre = prepare_source(batch_pre, self.idx_pad, device)
-        tgt, ref, msk_tgt = prepare_target(batch_tgt, self.idx_pad, self.idx_sep, self.idx_msk, self.mask_prefix, device)
-        pred = self.model.forward(src,  pre, tgt, msk_src, msk_pre, msk_tgt) #no log_softmax is applied
-        loss = self.criter(pred, ref) ### batch loss
-        valid_loss += loss.item() / torch.sum(ref != self.idx_pad)
-        if n_batch == 1:
-          print_pos_src_tgt_hyp_ref(pred[0], batch_pos[0], src[0], tgt[0], ref[0])
-
+    loss, n_batch, example = validation_loss(self.model, self.criter, self.valid_batchs, self.idx_pad)
     toc = time.time()
-    loss = 1.0*valid_loss/n_batch if n_batch else 0.0
-    logging.info('Validation step: {} #batchs: {} sec: {:.2f} loss: {:.3f}'.format(self.optScheduler._step, n_batch, toc-tic, loss))
+    return self.validation_report(self.optScheduler._step, n_batch, toc-tic, loss, example)
+
+  def prepare_batchs(self, validset, device):
+    ### tensors of all validation batchs (in dataset order)
+    tic = time.time()
+    batchs = []
+    for batch_pos, [batch_src, batch_tgt, batch_pre] in validset:
+      src, msk_src = prepare_source(batch_src, self.idx_pad, device)
+      pre, msk_pre = prepare_source(batch_pre, self.idx_pad, device)
+      tgt, ref, msk_tgt = prepare_target(batch_tgt, self.idx_pad, self.idx_sep, self.idx_msk, self.mask_prefix, device)
+      batchs.append([batch_pos[0], src, pre, tgt, ref, msk_src, msk_pre, msk_tgt])
+    logging.info('Prepared {} validation batchs in {:.2f} sec'.format(len(batchs), time.time()-tic))
+    return batchs
+
+  def validate_background(self):
+    ### validation of a snapshot of the model weights runs in another process, results are logged when available
+    if self.validator is None:
+      ctx = torch.multiprocessing.get_context('spawn')
+      self.valid_requests = ctx.Queue()
+      self.valid_results = ctx.Queue()
+      self.valid_pending = 0
+      self.validator = ctx.Process(target=validation_process, args=(self.model, self.criter, self.valid_batchs, self.idx_pad, self.valid_requests, self.valid_results), daemon=True)
+      self.validator.start()
+    self.valid_requests.put((self.optScheduler._step, snapshot(self.model.state_dict())))
+    self.valid_pending += 1
+    self.poll_validation()
+
+  def poll_validation(self, wait=False):
+    ### reports finished background validations (waits for all pending ones if wait)
+    while self.validator is not None and self.valid_pending > 0:
+      if not wait and self.valid_results.empty():
+        return
+      try:
+        result = self.valid_results.get(timeout=1)
+      except queue.Empty:
+        if not self.validator.is_alive():
+          logging.error('Background validation process died ({} validations lost)'.format(self.valid_pending))
+          self.valid_pending = 0
+        continue
+      self.validation_report(*result)
+      self.valid_pending -= 1
+
+  def stop_validation(self):
+    if self.validator is None:
+      return
+    self.poll_validation(wait=True)
+    if self.validator.is_alive():
+      self.valid_requests.put(None)
+    self.validator.join()
+    self.validator = None
+
+  def validation_report(self, step, n_batch, secs, loss, example):
+    if example is not None:
+      print_pos_src_tgt_hyp_ref(*example)
+    logging.info('Validation step: {} #batchs: {} sec: {:.2f} loss: {:.3f}'.format(step, n_batch, secs, loss))
     if tensorboard:
-      self.writer.add_scalar('Loss/valid', loss, self.optScheduler._step)
+      self.writer.add_scalar('Loss/valid', loss, step)
     return loss
 
+def synchronize(device):
+  ### waits for cuda kernels (timings)
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+
+
+peak_reset = False ### the peak resident size (VmHWM) of the process was reset by reset_peak_memory
+
+def reset_peak_memory(device):
+  ### starts a new window of peak_memory (linux resets the peak resident size VmHWM of the process)
+  global peak_reset
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    return
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+    peak_reset = True
+  except OSError: ### no permission, or not linux
+    peak_reset = False
+
+
+def peak_memory(device):
+  ### MB allocated by torch in cuda device, maximum resident size of the process in cpu, since last reset_peak_memory
+  ### None in cpu when the last reset failed (VmHWM and ru_maxrss would be the lifetime maximum)
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+    return torch.cuda.max_memory_allocated(device) / 2**20
+  if not peak_reset:
+    return None
+  try:
+    with open('/proc/self/status') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 2**10 ### kB
+  except OSError:
+    pass
+  return None
+
+
+def is_oom(e):
+  ### allocation failure in cuda (or cpu) device
+  return 'out of memory' in str(e) or "can't allocate memory" in str(e)
+
+
+def validation_loss(model, criter, batchs, idx_pad):
+  valid_loss = 0.
+  n_batch = 0
+  example = None
+  with torch.no_grad():
+    model.eval()
+    for pos, src, pre, tgt, ref, msk_src, msk_pre, msk_tgt in batchs:
+      n_batch += 1
+      pred = model.forward(src,  pre, tgt, msk_src, msk_pre, msk_tgt) #no log_softmax is applied
+      loss = criter(pred, ref) ### batch loss
+      valid_loss += loss.item() / torch.sum(ref != idx_pad).item()
+      if n_batch == 1:
+        example = (pred[0].clone(), pos, src[0].clone(), tgt[0].clone(), ref[0].clone())
+  loss = 1.0*valid_loss/n_batch if n_batch else 0.0
+  return loss, n_batch, example
+
+def validation_process(model, criter, batchs, idx_pad, requests, results):
+  ### background validation: computes the loss of each requested (step, weights) until None is received
+  while True:
+    request = requests.get()
+    if request is None:
+      return
+    step, state_dict = request
+    model.load_state_dict(state_dict)
+    tic = time.time()
+    loss, n_batch, example = validation_loss(model, criter, batchs, idx_pad)
+    results.put((step, n_batch, time.time()-tic, loss, example))
+
 def print_pos_src_tgt_hyp_ref(pred, pos, src, tgt, ref):
   hyp = torch.nn.functional.log_softmax(pred, dim=-1) #[lt,Vt]
   _, ind = torch.topk(hyp, k=1, dim=-1) #[lt,1]
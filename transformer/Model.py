@@ -1,10 +1,15 @@
 import sys
 import os
+import time
 import logging
 import torch
+import torch.utils.checkpoint
 import math
 import numpy as np
 import glob
+import json
+import threading
+import contextlib
 
 
 def numparameters(model):
@@ -29,7 +34,7 @@ def numparameters(model):
     return npars, size
 
 
-def load_checkpoint(suffix, model, optimizer, device):
+def load_checkpoint(suffix, model, optimizer, device, dataset=None):
     step = 0
     files = sorted(glob.glob("{}.checkpoint_????????.pt".format(suffix)))  ### I check if there is one model
     if len(files) == 0:
@@ -39,16 +44,56 @@ def load_checkpoint(suffix, model, optimizer, device):
     file = files[-1]  ### last is the newest
     checkpoint = torch.load(file, map_location=device)
     step = checkpoint['step']
+    if any(k.endswith('.WQ.weight') for k in checkpoint['model']):  ### checkpoint with separate WQ/WK/WV projections
+        checkpoint['optimizer'] = fuse_optimizer_state(checkpoint['model'], checkpoint['optimizer'], model)
     model.load_state_dict(checkpoint['model'])
     optimizer.load_state_dict(checkpoint['optimizer'])
     logging.info('Loaded model/optimizer step={} from {}'.format(step, file))
+    if dataset is not None and checkpoint.get('data') is not None:  ### resume data iteration where it was saved
+        dataset.load_state_dict(checkpoint['data'])
     return step, model, optimizer  ### this is for learning
 
 
-def save_checkpoint(suffix, model, optimizer, step, keep_last_n):
-    checkpoint = {'step': step, 'model': model.state_dict(), 'optimizer': optimizer.state_dict()}
-    torch.save(checkpoint, "{}.checkpoint_{:08d}.pt".format(suffix, step))
-    logging.info('Saved {}.checkpoint_{:08d}.pt'.format(suffix, step))
+def fuse_projections(state_dict, prefix=''):
+    ### replaces WQ/WK/WV entries (older checkpoints) by the fused WQKV ones in state_dict
+    for k in [k for k in state_dict if k.startswith(prefix) and k.endswith('WQ.weight')]:
+        base = k[:-len('WQ.weight')]
+        for p in ['weight', 'bias']:
+            state_dict[base + 'WQKV.' + p] = torch.cat([state_dict.pop(base + x + '.' + p) for x in ['WQ', 'WK', 'WV']], 0)
+    return state_dict
+
+
+def fuse_optimizer_state(model_state, optimizer_state, model):
+    ### optimizer state of a checkpoint with separate WQ/WK/WV projections (model_state) for the fused model
+    buffers = set(name for name, _ in model.named_buffers())
+    names, seen = [], set()
+    for name, t in model_state.items():  ### parameters in the order of the older model (without shared ones)
+        if name not in buffers and t.data_ptr() not in seen:
+            seen.add(t.data_ptr())
+            names.append(name)
+    state = {names[i]: st for i, st in optimizer_state['state'].items()}
+    params = [name for name, _ in model.named_parameters()]
+    for i, name in enumerate(params):
+        if '.WQKV.' in name and name not in state:
+            base, p = name.split('.WQKV.')
+            parts = [state.pop('{}.{}.{}'.format(base, x, p)) for x in ['WQ', 'WK', 'WV'] if '{}.{}.{}'.format(base, x, p) in state]
+            if len(parts) == 3:
+                state[name] = {k: torch.cat([st[k] for st in parts], 0) if torch.is_tensor(v) and v.dim() > 0 else v for k, v in parts[0].items()}
+    optimizer_state['state'] = {i: state[name] for i, name in enumerate(params) if name in state}
+    optimizer_state['param_groups'][0]['params'] = list(range(len(params)))
+    return optimizer_state
+
+
+def save_checkpoint(suffix, model, optimizer, step, keep_last_n, data=None):
+    checkpoint = {'step': step, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'data': data}
+    write_checkpoint(suffix, checkpoint, step, keep_last_n)
+
+
+def write_checkpoint(suffix, checkpoint, step, keep_last_n):
+    file = "{}.checkpoint_{:08d}.pt".format(suffix, step)
+    torch.save(checkpoint, file + '.tmp')
+    os.replace(file + '.tmp', file)  ### atomic rename: a checkpoint is either complete or absent
+    logging.info('Saved {}'.format(file))
     files = sorted(glob.glob(suffix + '.checkpoint_????????.pt'))
     while keep_last_n > 0 and len(files) > keep_last_n:
         f = files.pop(0)
@@ -56,6 +101,61 @@ def save_checkpoint(suffix, model, optimizer, step, keep_last_n):
         logging.debug('Removed checkpoint {}'.format(f))
 
 
+def snapshot(obj, copies=None):
+    ### copy of (nested dicts/lists of) tensors into host memory
+    ### tensors sharing memory (tied embeddings) are copied once and remain shared, as in torch.save of the originals
+    if copies is None:
+        copies = {}
+    if torch.is_tensor(obj):
+        key = (obj.device, obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride())
+        if key not in copies:
+            copies[key] = obj.detach().to('cpu', copy=True)
+        return copies[key]
+    if isinstance(obj, dict):
+        return {k: snapshot(v, copies) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v, copies) for v in obj)
+    return obj
+
+
+class CheckpointSaver():
+    ### saves checkpoints in background threads (at most max_inflight at a time), 0 saves synchronously
+    def __init__(self, suffix, keep_last_n, max_inflight=1):
+        super(CheckpointSaver, self).__init__()
+        self.suffix = suffix
+        self.keep_last_n = keep_last_n
+        self.max_inflight = max_inflight
+        self.inflight = threading.BoundedSemaphore(max(1, max_inflight))
+        self.lock = threading.Lock()  ### one rename/rotation at a time
+        self.threads = []
+
+    def save(self, model, optimizer, step, data=None):
+        ### data is the iteration state of the training Dataset
+        if self.max_inflight == 0:
+            save_checkpoint(self.suffix, model, optimizer, step, self.keep_last_n, data)
+            return
+        self.inflight.acquire()  ### blocks while max_inflight saves are being written
+        copies = {}  ### tensors shared by model and optimizer states remain shared
+        checkpoint = {'step': step, 'model': snapshot(model.state_dict(), copies), 'optimizer': snapshot(optimizer.state_dict(), copies), 'data': data}
+        thread = threading.Thread(target=self.write, args=(checkpoint, step))
+        self.threads = [t for t in self.threads if t.is_alive()] + [thread]
+        thread.start()
+
+    def write(self, checkpoint, step):
+        try:
+            with self.lock:
+                write_checkpoint(self.suffix, checkpoint, step, self.keep_last_n)
+        except Exception as e:
+            logging.error('Cannot save checkpoint step={}: {}'.format(step, e))
+        finally:
+            self.inflight.release()
+
+    def wait(self):
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
 def load_model(suffix, model, device, fmodel=None):
     if fmodel is not None:
         if not os.path.isfile(fmodel):
@@ -67,13 +167,117 @@ def load_model(suffix, model, device, fmodel=None):
             logging.info('No checkpoint found')
             sys.exit()
         fmodel = files[-1]  ### last is the newest
-    checkpoint = torch.load(fmodel, map_location=device)
-    step = checkpoint['step']
-    model.load_state_dict(checkpoint['model'])
+    if is_weights_file(fmodel):
+        step, state_dict = load_weights(fmodel)
+        assign_state_dict(model, state_dict, device)
+    else:
+        checkpoint = torch.load(fmodel, map_location=device)
+        step = checkpoint['step']
+        model.load_state_dict(checkpoint['model'])
     logging.info('Loaded model step={} from {}'.format(step, fmodel))
     return step, model
 
 
+##############################################################################################################
+### Inference weights (no optimizer, memory-mapped) ##########################################################
+##############################################################################################################
+WEIGHTS_MAGIC = b'MINMTW01'
+WEIGHTS_ALIGN = 64
+
+
+def is_weights_file(fweights):
+    with open(fweights, 'rb') as fd:
+        return fd.read(len(WEIGHTS_MAGIC)) == WEIGHTS_MAGIC
+
+
+def export_weights(fweights, state_dict, step, dtype=None):
+    ### file: magic, header length (8 bytes), json header, tensors data (each aligned to WEIGHTS_ALIGN bytes)
+    ### tensors sharing storage (shared embeddings) are written once
+    header = {'step': step, 'tensors': {}, 'aliases': {}}
+    seen = {}
+    tensors = []
+    offset = 0
+    for name, t in state_dict.items():
+        key = (t.data_ptr(), t.dtype, tuple(t.shape), tuple(t.stride()))
+        if key in seen:
+            header['aliases'][name] = seen[key]
+            continue
+        seen[key] = name
+        t = t.detach().to('cpu').contiguous()
+        if dtype is not None and t.is_floating_point():
+            t = t.to(dtype)
+        header['tensors'][name] = {'dtype': str(t.dtype).replace('torch.', ''), 'shape': list(t.shape), 'offset': offset}
+        tensors.append(t)
+        offset += -(-t.numel() * t.element_size() // WEIGHTS_ALIGN) * WEIGHTS_ALIGN
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * (-(len(WEIGHTS_MAGIC) + 8 + len(header)) % WEIGHTS_ALIGN)
+    with open(fweights + '.tmp', 'wb') as fd:
+        fd.write(WEIGHTS_MAGIC)
+        fd.write(len(header).to_bytes(8, 'little'))
+        fd.write(header)
+        for t in tensors:
+            data = (t.view(torch.int16) if t.dtype == torch.bfloat16 else t).numpy().tobytes()  ### numpy has no bfloat16
+            fd.write(data)
+            fd.write(b'\0' * (-len(data) % WEIGHTS_ALIGN))
+    os.replace(fweights + '.tmp', fweights)
+    logging.info('Exported {} tensors ({} shared) step={} into {}'.format(len(tensors), len(state_dict) - len(tensors), step, fweights))
+
+
+def load_weights(fweights):
+    ### returns step and state_dict with tensors memory-mapped from fweights (copy-on-write, nothing is read yet)
+    with open(fweights, 'rb') as fd:
+        fd.read(len(WEIGHTS_MAGIC))
+        len_header = int.from_bytes(fd.read(8), 'little')
+        header = json.loads(fd.read(len_header).decode('utf-8'))
+    data = np.memmap(fweights, dtype=np.uint8, mode='c', offset=len(WEIGHTS_MAGIC) + 8 + len_header)
+    state_dict = {}
+    for name, info in header['tensors'].items():
+        dtype = getattr(torch, info['dtype'])
+        np_dtype = np.dtype(np.int16) if dtype == torch.bfloat16 else torch.zeros(0, dtype=dtype).numpy().dtype
+        n_bytes = int(np.prod(info['shape'], dtype=np.int64)) * np_dtype.itemsize
+        t = torch.from_numpy(data[info['offset']:info['offset'] + n_bytes].view(np_dtype).reshape(info['shape']))
+        state_dict[name] = t.view(torch.bfloat16) if dtype == torch.bfloat16 else t
+    for name, shared in header['aliases'].items():
+        state_dict[name] = state_dict[shared]
+    return header['step'], state_dict
+
+
+def assign_state_dict(model, state_dict, device):
+    ### replaces model parameters/buffers by state_dict tensors (no copy when already in device with same dtype)
+    ### parameters tied in model (shared embeddings) remain tied: they are replaced by the same new parameter
+    state_dict = fuse_projections(dict(state_dict))
+    assigned = {}  ### id of model parameter => parameter assigned
+    for name, t in model.state_dict(keep_vars=True).items():
+        if name not in state_dict:
+            logging.error('Missing {} in model weights'.format(name))
+            sys.exit()
+        module_name, _, attr = name.rpartition('.')
+        module = model.get_submodule(module_name)
+        if attr in module._parameters:
+            if id(t) not in assigned:
+                value = state_dict[name].to(device=device, dtype=t.dtype)  ### reduced precision weights are upcast
+                assigned[id(t)] = torch.nn.Parameter(value, requires_grad=False)
+            module._parameters[attr] = assigned[id(t)]
+        else:
+            value = state_dict[name].to(device=device, dtype=t.dtype)
+            module._buffers[attr] = value
+    return model
+
+
+@contextlib.contextmanager
+def no_init():
+    ### skips random initialisation of parameters (for models whose weights are loaded afterwards)
+    names = ['uniform_', 'normal_', 'kaiming_uniform_', 'xavier_uniform_', 'ones_', 'zeros_', 'constant_']
+    inits = {name: getattr(torch.nn.init, name) for name in names}
+    for name in names:
+        setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+    try:
+        yield
+    finally:
+        for name, init in inits.items():
+            setattr(torch.nn.init, name, init)
+
+
 def prepare_source(batch_src, idx_pad, device):
     src = [torch.tensor(seq) for seq in batch_src]  # [bs, ls]
     src = torch.nn.utils.rnn.pad_sequence(src, batch_first=True, padding_value=idx_pad).to(device)  # [bs,ls]
@@ -94,12 +298,20 @@ def prepare_target(batch_tgt, idx_pad, idx_sep, idx_msk, do_mask_prefix, device)
     ref = torch.nn.utils.rnn.pad_sequence(ref, batch_first=True, padding_value=idx_pad).to(device)
     if do_mask_prefix:
         ref = mask_prefix(ref, idx_sep, idx_msk)
-    msk_tgt = (tgt != idx_pad).unsqueeze(-2) & (
-                1 - torch.triu(torch.ones((1, tgt.size(1), tgt.size(1)), device=tgt.device),
-                               diagonal=1)).bool()  # [bs,lt,lt]
+    msk_tgt = (tgt != idx_pad).unsqueeze(-2) & causal_mask(tgt.size(1), tgt.device)  # [bs,lt,lt]
     return tgt, ref, msk_tgt
 
 
+causal_masks = {}  # (lt, device) => [1,lt,lt] (built once)
+
+
+def causal_mask(lt, device):
+    # returns [1,lt,lt] (True for previous and current positions, False for next ones)
+    if (lt, device) not in causal_masks:
+        causal_masks[(lt, device)] = (1 - torch.triu(torch.ones((1, lt, lt), device=device), diagonal=1)).bool()
+    return causal_masks[(lt, device)]
+
+
 def mask_prefix(ref, idx_sep, idx_msk):
     # ref is [bs,lt]: idx_pref0 idx_pref1 ... idx_sep idx_tgt0 idx_tgt1 ... <eos> <pad> ...
     # replace tokens of prefix by idx_msk if not present in target
@@ -147,35 +359,53 @@ class Encoder_Decoder(torch.nn.Module):
         # tgt is [bs,lt]
         # msk_src is [bs,1,ls] (False where <pad> True otherwise)
         # mst_tgt is [bs,lt,lt]
+        msk_src, msk_pre, msk_tgt = Mask.of(msk_src), Mask.of(msk_pre), Mask.of(msk_tgt)  # shared by all layers
 
         ### encoder src #####
-        src = self.add_pos_enc(self.src_emb(src))  # [bs,ls,ed]
-        z_src = self.stacked_encoder_src(src, msk_src)  # [bs,ls,ed]
+        with torch.profiler.record_function('encode_src'):
+            src = self.add_pos_enc(self.src_emb(src))  # [bs,ls,ed]
+            z_src = self.stacked_encoder_src(src, msk_src)  # [bs,ls,ed]
         ### encoder pre #####
-        pre = self.add_pos_enc(self.pre_emb(pre))  # [bs,ls,ed]
-        z_pre = self.stacked_encoder_pre(pre, msk_pre)  # [bs,ls,ed]
+        with torch.profiler.record_function('encode_pre'):
+            pre = self.add_pos_enc(self.pre_emb(pre))  # [bs,ls,ed]
+            z_pre = self.stacked_encoder_pre(pre, msk_pre)  # [bs,ls,ed]
         ### decoder #####
-        tgt = self.add_pos_enc(self.tgt_emb(tgt))  # [bs,lt,ed]
-        z_tgt = self.stacked_decoder(tgt, msk_tgt, z_src, msk_src, z_pre, msk_pre)  # [bs,lt,ed]
+        with torch.profiler.record_function('decode'):
+            tgt = self.add_pos_enc(self.tgt_emb(tgt))  # [bs,lt,ed]
+            z_tgt = self.stacked_decoder(tgt, msk_tgt, z_src, msk_src, z_pre, msk_pre)  # [bs,lt,ed]
         ### generator ###
-        y = self.generator(z_tgt)  # [bs, lt, Vt]
+        with torch.profiler.record_function('generator'):
+            y = self.generator(z_tgt)  # [bs, lt, Vt]
         return y  ### returns logits (for learning)
 
     def encode_src(self, src, msk_src):               # je trouve la fonction encode et la fonction decode redondante avec forward
+        msk_src = Mask.of(msk_src)
         src = self.add_pos_enc(self.src_emb(src))  # [bs,ls,ed]
         z_src = self.stacked_encoder_src(src, msk_src)  # [bs,ls,ed]
         return z_src
 
 
     def encode_pre(self, pre, msk_pre):               # je trouve la fonction encode et la fonction decode redondante avec forward
+        msk_pre = Mask.of(msk_pre)
         pre = self.add_pos_enc(self.pre_emb(pre))  # [bs,ls,ed]
         z_pre = self.stacked_encoder_pre(pre, msk_pre)  # [bs,ls,ed]
         return z_pre
 
+    def checkpoint_activations(self, stacks):
+        # stacks is a list with any of src, pre, tgt
+        stacked = {'src': self.stacked_encoder_src, 'pre': self.stacked_encoder_pre, 'tgt': self.stacked_decoder}
+        for stack in stacks:
+            if stack not in stacked:
+                logging.error('bad stack {} for activation checkpointing (use src, pre, tgt)'.format(stack))
+                sys.exit()
+            stacked[stack].recompute = Recompute()
+            logging.info('Activation checkpointing in {} stack'.format(stack))
+
     def decode(self, tgt, msk_tgt, z_src, msk_src, z_pre, msk_pre):
-        assert z_src.shape[0] == tgt.shape[0]  ### src/tgt batch_sizes must be equal
+        assert tgt.shape[0] % z_src.shape[0] == 0  ### tgt batch_size is a multiple of src one (hypotheses of the same sentence share z_src)
         # z_src are the embeddings of the source words (encoder) [bs, sl, ed]
-        # tgt is the history (words already generated) for current step [bs, lt]
+        # tgt is the history (words already generated) for current step [bs, lt] or [bs*K, lt]
+        msk_tgt, msk_src, msk_pre = Mask.of(msk_tgt), Mask.of(msk_src), Mask.of(msk_pre)
         tgt = self.add_pos_enc(self.tgt_emb(tgt))  # [bs,lt,ed]
         z_tgt = self.stacked_decoder(tgt, msk_tgt, z_src, msk_src, z_pre, msk_pre)  # [bs,lt,ed]
         y = self.generator(z_tgt)  # [bs, lt, Vt]
@@ -183,6 +413,126 @@ class Encoder_Decoder(torch.nn.Module):
         return y  ### returns log_probs (for inference)
 
 
+##############################################################################################################
+### Mask #####################################################################################################
+##############################################################################################################
+class Mask():
+    # attention mask of a batch, built once and shared by all attention layers (and decoding steps)
+    # msk is [bs,1,lk] or [bs,lq,lk] (False where masked True otherwise)
+    # keeps the additive bias (0.0 or -Inf) used by MultiHead_Attn for each batch size (beam) and dtype
+    def __init__(self, msk):
+        self.msk = msk
+        self.biases = {}
+
+    @staticmethod
+    def of(msk):
+        if msk is None or isinstance(msk, Mask):
+            return msk
+        return Mask(msk)
+
+    def bias(self, bs, dtype):
+        # returns [bs,1,1,lk] or [bs,1,lq,lk] (first dimension is kept to 1 for masks shared by all the batch)
+        if (bs, dtype) not in self.biases:
+            msk = self.msk.unsqueeze(1)  # [bs, 1, 1, lk] or [bs, 1, lq, lk]
+            if msk.shape[0] not in (1, bs):
+                msk = torch.repeat_interleave(msk, bs // msk.shape[0], dim=0)
+            self.biases[(bs, dtype)] = torch.zeros(msk.shape, dtype=dtype, device=msk.device).masked_fill(msk == 0, float('-inf'))
+        return self.biases[(bs, dtype)]
+
+
+##############################################################################################################
+### Profiler #################################################################################################
+##############################################################################################################
+class Profiler():
+    # torch.profiler capture of steps A:B (both included) exports a chrome trace and a summary of top ops in dnet
+    # steps are learning updates (minmt-train.py) or batchs (minmt-translate.py)
+    def __init__(self, steps, dnet, name):
+        self.first, self.last = 0, 0
+        if steps:
+            try:
+                self.first, self.last = [int(x) for x in steps.split(':')]
+            except ValueError:
+                logging.error('bad -profile_steps {} (use A:B)'.format(steps))
+                sys.exit()
+        self.dnet = dnet
+        self.name = name
+        self.prof = None
+
+    def step(self, step):
+        # step is the number of steps done: stops after last one, starts before first one
+        if self.prof is not None and step >= self.last:
+            self.prof.stop()
+            self.export()
+            self.prof = None
+        elif self.prof is None and self.first <= step + 1 <= self.last:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.prof.start()
+            logging.info('Profiling {} steps {}:{}'.format(self.name, self.first, self.last))
+
+    def region(self, name):
+        # labels the enclosed code in traces
+        if self.prof is None:
+            return contextlib.nullcontext()
+        return torch.profiler.record_function(name)
+
+    def iterate(self, iterable, name='data'):
+        # iterates over iterable labelling the time spent getting each element
+        it = iter(iterable)
+        while True:
+            with self.region(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def export(self):
+        file = '{}/profile_{}_{}-{}'.format(self.dnet, self.name, self.first, self.last)
+        self.prof.export_chrome_trace(file + '.json')
+        sort_by = 'self_cuda_time_total' if torch.cuda.is_available() else 'self_cpu_time_total'
+        with open(file + '.txt', 'w') as f:
+            f.write(self.prof.key_averages().table(sort_by=sort_by, row_limit=50) + '\n')
+        logging.info('Saved profile {}.json (chrome trace) {}.txt (top ops)'.format(file, file))
+
+
+##############################################################################################################
+### Recompute (activation checkpointing) #####################################################################
+##############################################################################################################
+class Recompute():
+    # runs a layer without keeping its activations for backward, they are recomputed during backward
+    # keeps record of the bytes recomputed (which would be kept otherwise) and the time spent recomputing
+    def __init__(self):
+        self.nbytes = 0
+        self.secs = 0.
+
+    def __call__(self, layer, *args):
+        return torch.utils.checkpoint.checkpoint(self.forward, layer, *args)
+
+    def forward(self, layer, *args):
+        if not torch.is_grad_enabled():  # first pass (activations are not kept)
+            return layer(*args)
+        tic = time.time()  # recomputation during backward
+        with torch.autograd.graph.saved_tensors_hooks(self.pack, lambda t: t):
+            y = layer(*args)
+        self.secs += time.time() - tic
+        return y
+
+    def pack(self, t):
+        # parameters (or views of them, e.g. transposed weights) and the layer input are kept anyway: not counted
+        if t.requires_grad and (t.is_leaf or (t._base is not None and t._base.is_leaf)):
+            return t
+        self.nbytes += t.numel() * t.element_size()
+        return t
+
+    def reset(self):
+        nbytes, secs = self.nbytes, self.secs
+        self.nbytes, self.secs = 0, 0.
+        return nbytes, secs
+
+
 ##############################################################################################################
 ### Embedding RAS ################################################################################################
 ##############################################################################################################
@@ -228,10 +578,14 @@ class Stacked_Encoder_src(torch.nn.Module):
         self.encoderlayers = torch.nn.ModuleList(
             [Encoder_src(ff_dim, n_heads, emb_dim, qk_dim, v_dim, dropout) for _ in range(n_layers)])
         self.norm = torch.nn.LayerNorm(emb_dim, eps=1e-6)
+        self.recompute = None  # Recompute() for activation checkpointing
 
     def forward(self, src, msk_src):
         for i, encoderlayer in enumerate(self.encoderlayers):
-            src = encoderlayer(src, msk_src)  # [bs, ls, ed]
+            if self.recompute is not None and self.training:
+                src = self.recompute(encoderlayer, src, msk_src)  # [bs, ls, ed]
+            else:
+                src = encoderlayer(src, msk_src)  # [bs, ls, ed]
         return self.norm(src)
 
 
@@ -246,10 +600,14 @@ class Stacked_Encoder_pre(torch.nn.Module):
         self.encoderlayers = torch.nn.ModuleList(
             [Encoder_pre(ff_dim, n_heads, emb_dim, qk_dim, v_dim, dropout) for _ in range(n_layers)])
         self.norm = torch.nn.LayerNorm(emb_dim, eps=1e-6)
+        self.recompute = None  # Recompute() for activation checkpointing
 
     def forward(self, pre, msk_pre):
         for i, encoderlayer in enumerate(self.encoderlayers):
-            pre = encoderlayer(pre, msk_pre)  # [bs, ls, ed]
+            if self.recompute is not None and self.training:
+                pre = self.recompute(encoderlayer, pre, msk_pre)  # [bs, ls, ed]
+            else:
+                pre = encoderlayer(pre, msk_pre)  # [bs, ls, ed]
         return self.norm(pre)
 
 
@@ -262,10 +620,14 @@ class Stacked_Decoder(torch.nn.Module):
         self.decoderlayers = torch.nn.ModuleList(
             [Decoder(ff_dim, n_heads, emb_dim, qk_dim, v_dim, dropout) for _ in range(n_layers)])
         self.norm = torch.nn.LayerNorm(emb_dim, eps=1e-6)
+        self.recompute = None  # Recompute() for activation checkpointing
 
     def forward(self, tgt, msk_tgt, z_src, msk_src, z_pre, msk_pre):
         for i, decoderlayer in enumerate(self.decoderlayers):
-            tgt = decoderlayer(z_src, z_pre, tgt, msk_src, msk_pre, msk_tgt)
+            if self.recompute is not None and self.training:
+                tgt = self.recompute(decoderlayer, z_src, z_pre, tgt, msk_src, msk_pre, msk_tgt)
+            else:
+                tgt = decoderlayer(z_src, z_pre, tgt, msk_src, msk_pre, msk_tgt)
         return self.norm(tgt)
 
 
@@ -380,6 +742,9 @@ class Decoder(torch.nn.Module):
 
 
 
+sdpa = hasattr(torch.nn.functional, 'scaled_dot_product_attention')  # pytorch>=2.0
+
+
 ##############################################################################################################
 ### MultiHead_Attn RAS ###########################################################################################
 ##############################################################################################################
@@ -391,53 +756,64 @@ class MultiHead_Attn(torch.nn.Module):
         self.qd = qk_dim
         self.kd = qk_dim
         self.vd = v_dim
-        self.WQ = torch.nn.Linear(emb_dim, qk_dim * n_heads)
-        self.WK = torch.nn.Linear(emb_dim, qk_dim * n_heads)
-        self.WV = torch.nn.Linear(emb_dim, v_dim * n_heads)
+        self.WQKV = torch.nn.Linear(emb_dim, (2 * qk_dim + v_dim) * n_heads)  # fused WQ, WK, WV projections
         self.WO = torch.nn.Linear(v_dim * n_heads, emb_dim)
         self.dropout = torch.nn.Dropout(dropout)
 
-    def forward(self, q, k, v, msk=None):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_projections(state_dict, prefix)  # checkpoints with separate WQ, WK, WV projections
+        super(MultiHead_Attn, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, q, k, v, msk=None, need_weights=False):
         # q is [bs, lq, ed]
         # k is [bs, lk, ed]
         # v is [bs, lv, ed]
-        # msk is [bs, 1, ls] or [bs, lt, lt]
-        if msk is not None:
-            msk = msk.unsqueeze(1)  # [bs, 1, 1, ls] or [bs, 1, lt, lt]
+        # msk is a Mask (or a tensor) of [bs, 1, ls] or [bs, lt, lt]
+        # returns z [bs, lq, ed] (and attention weights [bs, nh, lq, lk] if need_weights)
         bs = q.shape[0]
         lq = q.shape[1]  ### sequence length of q vectors (length of target sentences)
         lk = k.shape[1]  ### sequence length of k vectors (may be length of source/target sentences)
         lv = v.shape[1]  ### sequence length of v vectors (may be length of source/target sentences)
         ed = q.shape[2]
-        if not bs == v.shape[0] == k.shape[0] :
-            K = bs // v.shape[0]
-            v = torch.repeat_interleave(v, K, dim = 0)    # je peux faire un repeat_interleaves car c'est le même vecteur pre pour les K options du beam search
-            k = torch.repeat_interleave(k, K, dim = 0)
         assert self.ed == q.shape[2] == k.shape[2] == v.shape[2]
         assert lk == lv  # when applied in decoder both refer the source-side (lq refers the target-side)
-        Q = self.WQ(q).contiguous().view([bs, lq, self.nh, self.qd]).permute(0, 2, 1,
-                                                                             3)  # => [bs,lq,nh*qd] => [bs,lq,nh,qd] => [bs,nh,lq,qd]
-       
-        K = self.WK(k).contiguous().view([bs, lv, self.nh, self.kd]).permute(0, 2, 1,
-                                                                             3)  # => [bs,lk,nh*kd] => [bs,lk,nh,kd] => [bs,nh,lk,kd]
-        V = self.WV(v).contiguous().view([bs, lv, self.nh, self.vd]).permute(0, 2, 1,
-                                                                             3)  # => [bs,lv,nh*vd] => [bs,lv,nh,vd] => [bs,nh,lv,vd]
-        # Scaled dot-product Attn from multiple Q, K, V vectors (bs*nh*l vectors)
-        Q = Q / math.sqrt(self.kd)
-        s = torch.matmul(Q, K.transpose(2,
-                                        3))  # [bs,nh,lq,qd] x [bs,nh,kd,lk] = [bs,nh,lq,lk] # thanks to qd==kd #in decoder lq are target words and lk are source words
-        if msk is not None:
-            if msk.shape[0] != bs :
-                K = bs // msk.shape[0]
-                msk = torch.repeat_interleave(msk, K, dim = 0)
-            s = s.masked_fill(msk == 0, float('-inf'))  # score=-Inf to masked tokens
-        w = torch.nn.functional.softmax(s, dim=-1)  # [bs,nh,lq,lk] (these are the attention weights)
-        w = self.dropout(w)  # [bs,nh,lq,lk]
-
-        z = torch.matmul(w, V)  # [bs,nh,lq,lk] x [bs,nh,lv,vd] = [bs,nh,lq,vd] #thanks to lk==lv
+        nq, nk, nv = self.nh * self.qd, self.nh * self.kd, self.nh * self.vd
+        if q is k and k is v:  # self-attention: one projection for Q, K, V
+            Q, K, V = self.WQKV(q).split([nq, nk, nv], dim=-1)
+        else:  # cross-attention: one projection for Q, one for K, V
+            W, b = self.WQKV.weight, self.WQKV.bias
+            Q = torch.nn.functional.linear(q, W[:nq], b[:nq])
+            if k is v:
+                K, V = torch.nn.functional.linear(k, W[nq:], b[nq:]).split([nk, nv], dim=-1)
+            else:
+                K = torch.nn.functional.linear(k, W[nq:nq + nk], b[nq:nq + nk])
+                V = torch.nn.functional.linear(v, W[nq + nk:], b[nq + nk:])
+        if not bs == V.shape[0] == K.shape[0]:
+            n = bs // V.shape[0]
+            V = torch.repeat_interleave(V, n, dim=0)  # je peux faire un repeat_interleaves car c'est le même vecteur pre pour les K options du beam search
+            K = torch.repeat_interleave(K, n, dim=0)
+        Q = Q.contiguous().view([bs, lq, self.nh, self.qd]).permute(0, 2, 1, 3)  # => [bs,lq,nh*qd] => [bs,lq,nh,qd] => [bs,nh,lq,qd]
+        K = K.contiguous().view([bs, lk, self.nh, self.kd]).permute(0, 2, 1, 3)  # => [bs,lk,nh*kd] => [bs,lk,nh,kd] => [bs,nh,lk,kd]
+        V = V.contiguous().view([bs, lv, self.nh, self.vd]).permute(0, 2, 1, 3)  # => [bs,lv,nh*vd] => [bs,lv,nh,vd] => [bs,nh,lv,vd]
+        bias = Mask.of(msk).bias(bs, Q.dtype) if msk is not None else None  # [bs,1,1,ls] or [bs,1,lt,lt] (-Inf to masked tokens)
+        if sdpa and not need_weights:  # fused kernels (pytorch>=2.0)
+            z = torch.nn.functional.scaled_dot_product_attention(Q, K, V, attn_mask=bias, dropout_p=self.dropout.p if self.training else 0.0)  # [bs,nh,lq,vd]
+            w = None
+        else:
+            # Scaled dot-product Attn from multiple Q, K, V vectors (bs*nh*l vectors)
+            Q = Q / math.sqrt(self.kd)
+            s = torch.matmul(Q, K.transpose(2,
+                                            3))  # [bs,nh,lq,qd] x [bs,nh,kd,lk] = [bs,nh,lq,lk] # thanks to qd==kd #in decoder lq are target words and lk are source words
+            if bias is not None:
+                s = s + bias  # score=-Inf to masked tokens
+            w = torch.nn.functional.softmax(s, dim=-1)  # [bs,nh,lq,lk] (these are the attention weights)
+            z = torch.matmul(self.dropout(w), V)  # [bs,nh,lq,lk] x [bs,nh,lv,vd] = [bs,nh,lq,vd] #thanks to lk==lv
+
         z = z.transpose(1, 2).contiguous().view([bs, lq, self.nh * self.vd])  # => [bs,lq,nh,vd] => [bs,lq,nh*vd]
-        z = self.WO(z)  # [bs,lq,ed]
-        return self.dropout(z)
+        z = self.dropout(self.WO(z))  # [bs,lq,ed]
+        if need_weights:
+            return z, w
+        return z
 
 
 ##############################################################################################################
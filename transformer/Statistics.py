@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import numpy as np
+
+##############################################################################################################
+### Corpus statistics ########################################################################################
+##############################################################################################################
+### computed with numpy over encoded corpora (EncodedCorpus/MappedCorpus: flat array of ids and line offsets)
+
+def token_counts(ids, voc_size, chunk_size=2**24):
+  ### returns the frequency of each token id [voc_size] (by chunks, bincount casts ids to int64)
+  counts = np.zeros(voc_size, dtype=np.int64)
+  for start in range(0, len(ids), chunk_size):
+    counts += np.bincount(ids[start:start+chunk_size], minlength=voc_size)[:voc_size]
+  return counts
+
+def corpus_stats(corpus, voc):
+  ### returns a dict with the statistics of corpus (tokens/OOVs from the token counts cached in corpus)
+  counts = corpus.token_counts(len(voc))
+  n_lines = len(corpus)
+  n_tok = int(counts.sum())
+  return {'lines': n_lines,
+          'tokens': n_tok,
+          'unks': int(counts[voc.idx_unk]),
+          'empty': int(np.count_nonzero(corpus.lens == 0)),
+          'lens': np.bincount(corpus.lens) if n_lines else np.zeros(1, dtype=np.int64)} #histogram of lengths
+
+def length_percentile(hist, q):
+  ### length below which q% of the lines are found (hist is the histogram of lengths)
+  cum = np.cumsum(hist)
+  return int(np.searchsorted(cum, q / 100.0 * cum[-1])) if cum[-1] else 0
+
+def log_stats(stats, fname, how='Read'):
+  n_lines, n_tok = stats['lines'], stats['tokens']
+  logging.info('{} Corpus ({} lines ~ {} tokens ~ {} OOVs [{:.2f}%] ~ {} empty [{:.2f}%] ~ length mean: {:.1f} median: {} p95: {} max: {}) from {}'.format(
+    how, n_lines, n_tok, stats['unks'], 100.0*stats['unks']/max(1,n_tok), stats['empty'], 100.0*stats['empty']/max(1,n_lines), n_tok/max(1,n_lines),
+    length_percentile(stats['lens'], 50), length_percentile(stats['lens'], 95), len(stats['lens'])-1, fname))
+  logging.debug('Length histogram of {}: {}'.format(fname, {l:int(c) for l,c in enumerate(stats['lens']) if c}))
+
+def padding(Lens, batchs):
+  ### returns the real and padded (slots) tokens of batchs [n_files] (Lens are the lengths of each file, batchs lists of positions)
+  ntoks = np.zeros(len(Lens), dtype=np.int64)
+  nslots = np.zeros(len(Lens), dtype=np.int64)
+  if len(batchs) == 0:
+    return ntoks, nslots
+  pos = np.concatenate(batchs)
+  sizes = np.array([len(b) for b in batchs], dtype=np.int64)
+  starts = np.cumsum(sizes) - sizes
+  for n in range(len(Lens)):
+    l = Lens[n][pos] + 2 ### <bos>, <eos>
+    ntoks[n] = l.sum()
+    nslots[n] = (np.maximum.reduceat(l, starts) * sizes).sum()
+  return ntoks, nslots
+
+def padding_efficiency(ntoks, nslots):
+  ### string with the percentage of real tokens over padded ones (all files and each file)
+  return '{:.1f}% [{}]'.format(100.0*ntoks.sum()/max(1,nslots.sum()), ', '.join(['{:.1f}%'.format(100.0*t/max(1,s)) for t,s in zip(ntoks, nslots)]))